@@ -22,11 +22,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
 import os
 from sqlite3 import Error as DatabaseError
 import disnake
 from disnake.ext import commands
-from cogs.utils import database, activity, parser, version, schema, docker
+from cogs.utils import backup, database, activity, parser, version, schema, docker
 from cogs.utils.i18n import Response, StaticResponse
 
 
@@ -50,78 +51,126 @@ class ReactionLight(commands.InteractionBot):
         self.directory = os.path.dirname(os.path.realpath(__file__))
         self.config = parser.Config(self.directory)
         self.activities = activity.Activities(f"{self.directory}/files/activities.csv")
-        self.db = database.Database(f"{self.directory}/files/reactionlight.db")
+        self.db = database.AsyncDatabase(
+            database.Database(
+                f"{self.directory}/files/reactionlight.db",
+                journal_mode=self.config.db_journal_mode,
+                synchronous=self.config.db_synchronous,
+                cache_size=self.config.db_cache_size,
+                mmap_size=self.config.db_mmap_size,
+                busy_timeout=self.config.db_busy_timeout,
+                guild_settings_cache_size=self.config.db_guild_settings_cache_size,
+                admins_cache_size=self.config.db_admins_cache_size,
+                selections_cache_size=self.config.db_selections_cache_size,
+                batch_window=self.config.db_batch_window_ms / 1000,
+                batch_size=self.config.db_batch_size,
+                slow_query_ms=self.config.db_slow_query_ms,
+                slow_query_log_size=self.config.db_slow_query_log_size,
+            )
+        )
+        self.backups = backup.BackupManager(
+            f"{self.directory}/files/reactionlight.db",
+            f"{self.directory}/files/backups",
+            keep=self.config.db_backup_keep,
+            pages=self.config.db_backup_pages,
+            sleep=self.config.db_backup_sleep_ms / 1000,
+        )
+        # Set while migrations that need the Discord cache are still pending, on_ready runs them once connected
+        self.schema_handler = self.migrate_database()
         self.version = version.get(self.directory)
         self.response = Response(self, f"{self.directory}/i18n", self.config.language)
         intents = disnake.Intents(message_content=True, guild_messages=True, guild_reactions=True, guilds=True)
         super().__init__(intents=intents)
+        self.before_slash_command_invoke(self.load_language)
 
         for extension in extensions:
             self.load_extension(extension)
 
-    def isadmin(self, member, guild_id):
+    async def load_language(self, inter):
+        # Response.get never waits for the database and uses the global language on a cache miss, so the guild's
+        # settings are loaded before a command sends its (translated) responses
+        if inter.guild is not None and self.db.cached_guild_settings(inter.guild.id) is None:
+            try:
+                await self.db.get_guild_settings(inter.guild.id)
+            except DatabaseError:
+                # The command reports database errors itself
+                pass
+
+    async def isadmin(self, member, guild_id):
         # Checks if command author has an admin role that was added with rl!admin
-        try:
-            admins = self.db.get_admins(guild_id)
-        except DatabaseError as error:
-            print(self.response.get("db-error-admin-check").format(exception=error))
-            return False
+        # The admin roles are usually cached, the database worker is only waited on for a miss
+        admins = self.db.cached_admins(guild_id)
+        if admins is None:
+            try:
+                admins = await self.db.get_admins(guild_id)
+            except DatabaseError as error:
+                print(self.response.get("db-error-admin-check").format(exception=error))
+                return False
 
         try:
-            member_roles = [role.id for role in member.roles]
-            return [admin_role for admin_role in admins if admin_role in member_roles]
+            return any(role.id in admins for role in member.roles)
 
         except AttributeError:
             # Error raised from 'fake' users, such as webhooks
             return False
 
-    async def database_updates(self):
-        # Handles database schema updates
+    async def close(self):
+        await super().close()
+        self.db.close()
+
+    async def backup_database(self, method="online"):
+        # Commits batched writes, then copies the database on a separate thread so the database worker stays free
+        await self.db.flush()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.backups.create, method)
+
+    def migrate_database(self):
+        # Applies schema updates before connecting to Discord, returns the handler if some still need the Discord cache
         handler = schema.SchemaHandler(f"{self.directory}/files/reactionlight.db", self)
-        if handler.version == 0:
-            handler.zero_to_one()
-            try:
-                messages = self.db.fetch_all_messages()
-            except DatabaseError:
-                print("Couldn't fetch messages while migrating")
-                return
+        if handler.current:
+            return None
 
-            for message in messages:
-                channel_id = message[1]
-                channel = await self.getchannel(channel_id)
-                try:
-                    self.db.add_guild(channel.id, channel.guild.id)
-                except DatabaseError:
-                    print("Couldn't add guilds while migrating")
-                    return
+        try:
+            current = handler.migrate_offline()
+        except DatabaseError as error:
+            # The failed step was rolled back, the database is left at the last completed version
+            print(f"Couldn't migrate the database past version {handler.version}: {error}")
+            return handler
 
-        if handler.version == 1:
-            handler.one_to_two()
+        if not current:
+            return handler
 
-        if handler.version == 2:
-            handler.two_to_three()
+        # Rebuild the caches from the migrated tables
+        self.db.database.load_caches()
+        return None
 
-        if handler.version == 3:
-            handler.three_to_four()
+    async def database_updates(self):
+        # Handles the schema updates that need the Discord cache, a no-op once the schema is current
+        handler, self.schema_handler = self.schema_handler, None
+        if handler is None:
+            return
 
-        if handler.version == 4:
-            handler.four_to_five()
+        # Commits any batched writes so the migration can take the write lock
+        await self.db.flush()
+        try:
+            await handler.migrate()
+        except DatabaseError as error:
+            # Retried on the next on_ready
+            print(f"Couldn't migrate the database past version {handler.version}: {error}")
+            self.schema_handler = handler
 
-        if handler.version == 5:
-            handler.five_to_six()
+        # Rebuild the caches from the migrated tables
+        await self.db.load_caches()
 
     async def report(self, text, guild_id=None, embed=None):
         # Send a message to the system channel (if set)
         if guild_id:
             try:
-                server_channel = self.db.fetch_systemchannel(guild_id)
+                server_channel = await self.db.fetch_systemchannel(guild_id)
             except DatabaseError as error:
                 await self.report(self.response.get("db-error-fetching-systemchannels-server").format(exception=error, text=text))
                 return
 
-            if server_channel:
-                server_channel = server_channel[0][0]
-
             if server_channel:
                 try:
                     target_channel = await self.getchannel(server_channel)
@@ -47,7 +47,7 @@ class Admin(commands.Cog):
         if role is None or action == "list":
             # Lists all admin IDs in the database, mentioning them if possible
             try:
-                admin_ids = self.bot.db.get_admins(inter.guild.id)
+                admin_ids = await self.bot.db.get_admins(inter.guild.id)
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-fetching-admins", guild_id=inter.guild.id).format(exception=error),
@@ -71,7 +71,7 @@ class Admin(commands.Cog):
         elif action == "add":
             # Adds an admin role ID to the database
             try:
-                self.bot.db.add_admin(role.id, inter.guild.id)
+                await self.bot.db.add_admin(role.id, inter.guild.id)
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-admin-add", guild_id=inter.guild.id).format(exception=error), inter.guild.id
@@ -83,7 +83,7 @@ class Admin(commands.Cog):
         elif action == "remove":
             # Removes an admin role ID from the database
             try:
-                self.bot.db.remove_admin(role.id, inter.guild.id)
+                await self.bot.db.remove_admin(role.id, inter.guild.id)
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-admin-remove", guild_id=inter.guild.id).format(exception=error),
@@ -22,59 +22,97 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
 from datetime import datetime
+import time
 from sqlite3 import Error as DatabaseError
 import disnake
 from disnake.ext import commands, tasks
 
+# Seconds a guild stays unreachable in the cleanup queue before its database entries are purged
+CLEANUP_DELAY = 86400
+# Seconds to wait before retrying after the cleanup queue could not be processed
+RETRY_DELAY = 3600
+# Free pages released per incremental vacuum step, the database worker is free for other queries between steps
+VACUUM_STEP_PAGES = 256
+
 
 class Cleaner(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # Wakes up purge_due_guilds when a guild is queued, so it can reschedule for the new due time
+        self.queue_changed = asyncio.Event()
         self.cleandb.start()
-        self.check_cleanup_queued_guilds.start()
+        self.purge_due_guilds.start()
+        self.maintenance.start()
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         try:
-            self.bot.db.add_cleanup_guild(guild.id, round(datetime.utcnow().timestamp()))
+            await self.bot.db.add_cleanup_guild(guild.id, round(datetime.utcnow().timestamp()))
         except DatabaseError as error:
             await self.bot.report(self.bot.response.get("db-error-add-cleanup-removal").format(exception=error))
             return
+        self.queue_changed.set()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.dequeue_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        await self.dequeue_guild(guild)
+
+    async def dequeue_guild(self, guild):
+        # The guild is reachable again, so it must not be purged
+        if not self.bot.db.cleanup_queued(guild.id):
+            # guild_available fires for every guild on every connect, most were never queued
+            return
+        try:
+            await self.bot.db.remove_cleanup_guild(guild.id)
+        except DatabaseError as error:
+            await self.bot.report(self.bot.response.get("db-error-removing-cleanup").format(exception=error))
 
     @tasks.loop(hours=24)
     async def cleandb(self):
         await self.bot.wait_until_ready()
         try:
             # Cleans the database by deleting rows of reaction role messages that don't exist anymore
-            messages = self.bot.db.fetch_all_messages()
-        except DatabaseError as error:
-            await self.bot.report(self.bot.response.get("db-error-fetching-cleaning").format(exception=error))
-            return
+            # The messages are streamed in pages, so memory use doesn't grow with the number of messages
+            async for message in self.bot.db.iter_all_messages():
+                try:
+                    message_id = message[0]
+                    channel_id = message[1]
+                    guild_id = message[2]
+                    limit_to_one_status = message[3]
+                    channel = await self.bot.fetch_channel(channel_id)
+
+                    await channel.fetch_message(message[0])
+
+                except disnake.NotFound as e:
+                    # If unknown channel or unknown message
+                    if e.code == 10003 or e.code == 10008:
+                        try:
+                            await self.bot.db.delete(message[0])
+                        except DatabaseError as error:
+                            await self.bot.report(
+                                self.bot.response.get("db-error-fetching-cleaning").format(exception=error), channel.guild.id
+                            )
+                            return
 
-        for message in messages:
-            try:
-                message_id = message[0]
-                channel_id = message[1]
-                guild_id = message[2]
-                limit_to_one_status = message[3]
-                channel = await self.bot.fetch_channel(channel_id)
-
-                await channel.fetch_message(message[0])
-
-            except disnake.NotFound as e:
-                # If unknown channel or unknown message
-                if e.code == 10003 or e.code == 10008:
-                    try:
-                        self.bot.db.delete(message[0])
-                    except DatabaseError as error:
                         await self.bot.report(
-                            self.bot.response.get("db-error-fetching-cleaning").format(exception=error), channel.guild.id
+                            self.bot.response.get("db-message-delete-success").format(
+                                message_id=message_id,
+                                channel_id=channel_id,
+                                guild_id=guild_id,
+                                limit_to_one_status=limit_to_one_status,
+                            ),
+                            guild_id,
                         )
-                        return
-
+                except disnake.Forbidden:
+                    # If we can't fetch the channel due to the bot not being in the guild or permissions we usually cant mention it or get the guilds id using the channels object
                     await self.bot.report(
-                        self.bot.response.get("db-message-delete-success").format(
+                        self.bot.response.get("db-forbidden-message").format(
                             message_id=message_id,
                             channel_id=channel_id,
                             guild_id=guild_id,
@@ -82,94 +120,147 @@ class Cleaner(commands.Cog):
                         ),
                         guild_id,
                     )
-            except disnake.Forbidden:
-                # If we can't fetch the channel due to the bot not being in the guild or permissions we usually cant mention it or get the guilds id using the channels object
-                await self.bot.report(
-                    self.bot.response.get("db-forbidden-message").format(
-                        message_id=message_id, channel_id=channel_id, guild_id=guild_id, limit_to_one_status=limit_to_one_status
-                    ),
-                    guild_id,
-                )
+        except DatabaseError as error:
+            await self.bot.report(self.bot.response.get("db-error-fetching-cleaning").format(exception=error))
+            return
 
         try:
-            guilds = self.bot.db.fetch_all_guilds()
             # Get the cleanup queued guilds
-            cleanup_guild_ids = self.bot.db.fetch_cleanup_guilds(guild_ids_only=True)
+            cleanup_guild_ids = set(await self.bot.db.fetch_cleanup_guilds(guild_ids_only=True))
         except DatabaseError as error:
             await self.bot.report(self.bot.response.get("db-error-fetching-cleaning-guild").format(exception=error))
             return
 
-        for guild_id in guilds:
-            try:
-                await self.bot.fetch_guild(guild_id)
-                if guild_id in cleanup_guild_ids:
-                    try:
-                        self.bot.db.remove_cleanup_guild(guild_id)
-                    except DatabaseError as error:
-                        await self.bot.report(self.bot.response.get("db-error-removing-cleanup").format(exception=error))
-                        return
-            except disnake.Forbidden:
-                # If unknown guild
-                if guild_id in cleanup_guild_ids:
-                    continue
-                else:
-                    try:
-                        self.bot.db.add_cleanup_guild(guild_id, round(datetime.utcnow().timestamp()))
-                    except DatabaseError as error:
-                        await self.bot.report(self.bot.response.get("db-error-add-cleanup").format(exception=error))
-                        return
-            except DatabaseError as error:
-                await self.bot.report(self.bot.response.get("db-error-fetching-guild").format(exception=error))
-                return
-
         try:
-            cleanup_guilds = self.bot.db.fetch_cleanup_guilds()
-        except DatabaseError as error:
-            await self.bot.report(self.bot.response.get("db-error-fetching-cleanup-guild").format(exception=error))
-            return
-
-        current_timestamp = round(datetime.utcnow().timestamp())
-
-        for guild in cleanup_guilds:
-            if int(guild[1]) - current_timestamp <= -86400:
-                # The guild has been invalid / unreachable for more than 24 hrs, try one more fetch then give up and purge the guilds database entries
+            async for guild_id in self.bot.db.iter_all_guilds():
                 try:
-                    await self.bot.fetch_guild(guild[0])
-                    self.bot.db.remove_cleanup_guild(guild[0])
-                    continue
+                    await self.bot.fetch_guild(guild_id)
+                    if guild_id in cleanup_guild_ids:
+                        try:
+                            await self.bot.db.remove_cleanup_guild(guild_id)
+                        except DatabaseError as error:
+                            await self.bot.report(self.bot.response.get("db-error-removing-cleanup").format(exception=error))
+                            return
                 except disnake.Forbidden:
-                    try:
-                        self.bot.db.remove_guild(guild[0])
-                    except DatabaseError as error:
-                        await self.bot.report(self.bot.response.get("db-error-deleting-cleaning-guild").format(exception=error))
-                        return
-                    try:
-                        self.bot.db.remove_cleanup_guild(guild[0])
-                    except DatabaseError as error:
-                        await self.bot.report(self.bot.response.get("db-error-deleting-cleaning-guild").format(exception=error))
-                        return
+                    # If unknown guild
+                    if guild_id in cleanup_guild_ids:
+                        continue
+                    else:
+                        try:
+                            await self.bot.db.add_cleanup_guild(guild_id, round(datetime.utcnow().timestamp()))
+                        except DatabaseError as error:
+                            await self.bot.report(self.bot.response.get("db-error-add-cleanup").format(exception=error))
+                            return
+                        self.queue_changed.set()
                 except DatabaseError as error:
-                    await self.bot.report(self.bot.response.get("db-error-removing-cleanup").format(exception=error))
+                    await self.bot.report(self.bot.response.get("db-error-fetching-guild").format(exception=error))
                     return
+        except DatabaseError as error:
+            await self.bot.report(self.bot.response.get("db-error-fetching-cleaning-guild").format(exception=error))
+            return
 
-    @tasks.loop(hours=6)
-    async def check_cleanup_queued_guilds(self):
+    @tasks.loop()
+    async def purge_due_guilds(self):
         await self.bot.wait_until_ready()
-        # Checks if an unreachable guild has become available again and removes it from the cleanup queue
+        # Sleeps until the oldest queued guild is due (or the queue changes), then purges the guilds that are due
+        self.queue_changed.clear()
         try:
-            cleanup_guild_ids = self.bot.db.fetch_cleanup_guilds(guild_ids_only=True)
+            next_timestamp = await self.bot.db.next_cleanup_timestamp()
         except DatabaseError as error:
-            await self.bot.report(self.bot.response.get("db-error-fetching-cleaning-guild").format(exception=error))
+            await self.bot.report(self.bot.response.get("db-error-fetching-cleanup-guild").format(exception=error))
+            await self.wait_for_queue(RETRY_DELAY)
+            return
+
+        if next_timestamp is None:
+            await self.wait_for_queue(None)
             return
-        for guild_id in cleanup_guild_ids:
+
+        delay = next_timestamp + CLEANUP_DELAY - datetime.utcnow().timestamp()
+        if delay > 0:
+            await self.wait_for_queue(delay)
+            return
+
+        if not await self.purge_expired_guilds():
+            await self.wait_for_queue(RETRY_DELAY)
+
+    async def wait_for_queue(self, timeout):
+        try:
+            await asyncio.wait_for(self.queue_changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def purge_expired_guilds(self):
+        # Purges the guilds that have been unreachable for more than CLEANUP_DELAY, returns False if some could not be checked
+        due_timestamp = round(datetime.utcnow().timestamp()) - CLEANUP_DELAY
+        try:
+            due_guilds = await self.bot.db.fetch_due_cleanup_guilds(due_timestamp)
+        except DatabaseError as error:
+            await self.bot.report(self.bot.response.get("db-error-fetching-cleanup-guild").format(exception=error))
+            return False
+
+        expired_guilds = []
+        retry = False
+        for guild_id, _ in due_guilds:
+            # The guild has been invalid / unreachable for more than 24 hrs, try one more fetch then give up and purge the guilds database entries
             try:
                 await self.bot.fetch_guild(guild_id)
-                self.bot.db.remove_cleanup_guild(guild_id)
-            except disnake.Forbidden:
-                continue
+                await self.bot.db.remove_cleanup_guild(guild_id)
+            except (disnake.Forbidden, disnake.NotFound):
+                # No access anymore, or the guild was deleted
+                expired_guilds.append(guild_id)
+            except disnake.HTTPException:
+                # Left in the queue and retried later, the guilds behind it are still handled
+                retry = True
             except DatabaseError as error:
                 await self.bot.report(self.bot.response.get("db-error-removing-cleanup").format(exception=error))
-                return
+                retry = True
+                break
+
+        if expired_guilds:
+            # Purges every expired guild (and its cleanup queue entry) in a single transaction
+            try:
+                await self.bot.db.remove_guilds(expired_guilds)
+            except DatabaseError as error:
+                await self.bot.report(self.bot.response.get("db-error-deleting-cleaning-guild").format(exception=error))
+                return False
+
+        return not retry
+
+    @tasks.loop(hours=24)
+    async def maintenance(self):
+        await self.bot.wait_until_ready()
+        started = time.perf_counter()
+        try:
+            removed = await self.bot.db.sweep_orphans([guild.id for guild in self.bot.guilds])
+            await self.bot.db.optimize()
+            # Incremental vacuum in small steps until the free pages run out or the time budget is spent
+            deadline = time.perf_counter() + self.bot.config.db_maintenance_vacuum_ms / 1000
+            freed_pages = 0
+            while time.perf_counter() < deadline:
+                freed = await self.bot.db.incremental_vacuum(VACUUM_STEP_PAGES)
+                if not freed:
+                    break
+                freed_pages += freed
+            free_pages, page_size = await self.bot.db.free_pages()
+        except DatabaseError as error:
+            await self.bot.report(self.bot.response.get("db-error-maintenance").format(exception=error))
+            return
+
+        reclaimed = freed_pages * page_size
+        print(
+            f"Database maintenance: removed {removed} orphaned rows, reclaimed {reclaimed} bytes"
+            f" ({free_pages * page_size} bytes still free) in {time.perf_counter() - started:.2f}s"
+        )
+        if any(removed.values()) or reclaimed:
+            await self.bot.report(
+                self.bot.response.get("db-maintenance-report").format(
+                    reactionroles=removed["reactionroles"],
+                    admins=removed["admins"],
+                    guild_settings=removed["guild_settings"],
+                    reclaimed=round(reclaimed / 1024),
+                    free=round(free_pages * page_size / 1024),
+                )
+            )
 
 
 def setup(bot):
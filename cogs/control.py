@@ -22,13 +22,15 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import io
 import os
 from sys import platform
-from shutil import copy
+from sqlite3 import Error as DatabaseError
 import disnake
 from disnake.ext import commands, tasks
-from cogs.utils import github
+from cogs.utils import backup, github
 from cogs.utils.i18n import StaticResponse
+from cogs.utils.locks import lock_manager
 
 static_response = StaticResponse()
 
@@ -68,7 +70,7 @@ class Control(commands.Cog):
     @commands.guild_only()
     async def print_version(self, inter):
         await inter.response.defer()
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.edit_original_message(content=self.bot.response.get("not-admin", guild_id=inter.guild.id))
             return
 
@@ -113,13 +115,79 @@ class Control(commands.Cog):
             cmd = os.popen("git pull")
             cmd.close()
             await inter.channel.send(self.bot.response.get("database-backup", guild_id=inter.guild.id))
-            copy(f"{self.bot.directory}/files/reactionlight.db", f"{self.bot.directory}/files/reactionlight.db.bak")
+            try:
+                await self.bot.backup_database()
+            except (DatabaseError, OSError, backup.BackupError) as error:
+                # Not restarting into the new version without a backup to go back to
+                await inter.channel.send(
+                    self.bot.response.get("database-backup-error", guild_id=inter.guild.id).format(exception=error)
+                )
+                return
+
             self.restart()
             await inter.channel.send(self.bot.response.get("restart", guild_id=inter.guild.id))
             await self.bot.close()
         else:
             await inter.send(self.bot.response.get("windows-error", guild_id=inter.guild.id))
 
+    @commands.is_owner()
+    @controlbot_group.sub_command(name="dbstats", description=static_response.get("brief-dbstats"))
+    async def dbstats(
+        self, inter, reset: bool = commands.Param(description=static_response.get("dbstats-option-reset"), default=False)
+    ):
+        await inter.response.defer()
+        instrumentation = self.bot.db.instrumentation
+        report = io.BytesIO(f"{instrumentation.report()}\n\n{instrumentation.dump()}\n".encode("utf-8"))
+        if reset:
+            instrumentation.reset()
+        await inter.edit_original_message(
+            content=self.bot.response.get("database-stats", guild_id=inter.guild.id),
+            file=disnake.File(report, filename="database-stats.txt"),
+        )
+
+    @commands.is_owner()
+    @controlbot_group.sub_command(name="eventstats", description=static_response.get("brief-eventstats"))
+    async def eventstats(self, inter):
+        await inter.response.defer()
+        roles = self.bot.get_cog("Roles")
+        sections = {
+            "Event pipeline": roles.pipeline.stats(),
+            "Role edits": roles.role_edits.stats(),
+            "Notifications": roles.notifications.stats(),
+            "Locks": lock_manager.stats(),
+        }
+        report = "\n\n".join(
+            f"{title}\n" + "\n".join(f"  {name}: {value}" for name, value in stats.items()) for title, stats in sections.items()
+        )
+        await inter.edit_original_message(
+            content=f"{self.bot.response.get('event-stats', guild_id=inter.guild.id)}\n```\n{report}\n```"
+        )
+
+    @commands.is_owner()
+    @controlbot_group.sub_command(name="backup", description=static_response.get("brief-backup"))
+    async def backup_cmd(
+        self,
+        inter,
+        method: str = commands.Param(
+            description=static_response.get("backup-option-method"), choices=set(backup.METHODS), default="online"
+        ),
+    ):
+        await inter.response.defer()
+        await inter.edit_original_message(content=self.bot.response.get("database-backup", guild_id=inter.guild.id))
+        try:
+            path = await self.bot.backup_database(method)
+        except (DatabaseError, OSError, backup.BackupError) as error:
+            await inter.edit_original_message(
+                content=self.bot.response.get("database-backup-error", guild_id=inter.guild.id).format(exception=error)
+            )
+            return
+
+        await inter.edit_original_message(
+            content=self.bot.response.get("database-backup-done", guild_id=inter.guild.id).format(
+                path=os.path.relpath(path, self.bot.directory), size=round(os.path.getsize(path) / 1048576, 2)
+            )
+        )
+
 
 def setup(bot):
     bot.add_cog(Control(bot))
@@ -33,6 +33,8 @@ class Errors(commands.Cog):
     @commands.Cog.listener()
     async def on_slash_command_error(self, inter, error):
         if isinstance(error, commands.errors.NotOwner):
+            # The failed check stopped the command before its language was loaded
+            await self.bot.load_language(inter)
             await inter.send(self.bot.response.get("not-owner", guild_id=inter.guild.id))
         elif isinstance(error, commands.errors.NoPrivateMessage):
             await inter.send(self.bot.response.get("no-dm"))
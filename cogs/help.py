@@ -35,7 +35,7 @@ class Help(commands.Cog):
     @commands.slash_command(name="help", description=static_response.get("brief-help"))
     @commands.guild_only()
     async def hlp(self, inter):
-        if self.bot.isadmin(inter.author, inter.guild.id):
+        if await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.response.defer()
             await inter.edit_original_message(
                 content=self.bot.response.get("help-messages-title", guild_id=inter.guild.id)
@@ -40,7 +40,7 @@ class Message(commands.Cog):
     async def formatted_channel_list(self, channel):
         # Returns a formatted numbered list of reaction roles message present in a given channel
         try:
-            all_messages = self.bot.db.fetch_messages(channel.id)
+            all_messages = await self.bot.db.fetch_messages(channel.id)
         except DatabaseError as error:
             await self.bot.report(
                 self.bot.response.get("db-error-fetching-messages", guild_id=channel.guild.id).format(exception=error),
@@ -71,7 +71,7 @@ class Message(commands.Cog):
     @message_group.sub_command(name="new", description=static_response.get("brief-message-new"))
     @commands.guild_only()
     async def new(self, inter):
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.send(self.bot.response.get("new-reactionrole-noadmin", guild_id=inter.guild.id))
             return
 
@@ -370,7 +370,7 @@ class Message(commands.Cog):
         if not cancelled:
             # Ait we are (almost) all done, now we just need to insert that into the database and add the reactions 💪
             try:
-                self.bot.db.add_reaction_role(rl_object)
+                await self.bot.db.add_reaction_role(rl_object)
             except database.DuplicateInstance:
                 await inter.channel.send(self.bot.response.get("new-reactionrole-already-exists", guild_id=inter.guild.id))
                 return
@@ -398,7 +398,7 @@ class Message(commands.Cog):
         number: int = commands.Param(description=static_response.get("message-edit-option-number")),
     ):
         await inter.response.defer()
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.edit_original_message(content=self.bot.response.get("not-admin", guild_id=inter.guild.id))
             return
 
@@ -421,7 +421,7 @@ class Message(commands.Cog):
                 # Tries to edit the reaction-role message
                 # Raises errors if the channel sent was invalid or if the bot cannot edit the message
                 try:
-                    all_messages = self.bot.db.fetch_messages(channel.id)
+                    all_messages = await self.bot.db.fetch_messages(channel.id)
                 except DatabaseError as error:
                     await self.bot.report(
                         self.bot.response.get("db-error-fetching-messages", guild_id=inter.guild.id).format(message_ids=error),
@@ -593,7 +593,7 @@ class Message(commands.Cog):
         reaction: str = commands.Param(description=static_response.get("message-reaction-option-reaction"), default=None),
         role: disnake.Role = commands.Param(description=static_response.get("message-reaction-option-role"), default=None),
     ):
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.send(self.bot.response.get("not-admin", guild_id=inter.guild.id))
             return
 
@@ -622,7 +622,7 @@ class Message(commands.Cog):
                 return
 
         try:
-            all_messages = self.bot.db.fetch_messages(channel.id)
+            all_messages = await self.bot.db.fetch_messages(channel.id)
         except DatabaseError as error:
             await self.bot.report(
                 self.bot.response.get("db-error-fetching-messages", guild_id=inter.guild.id).format(exception=error),
@@ -652,7 +652,7 @@ class Message(commands.Cog):
 
         if action == "add":
             try:
-                react = self.bot.db.add_reaction(message_to_edit.id, role.id, sanitize_emoji(reaction))
+                react = await self.bot.db.add_reaction(message_to_edit.id, role.id, sanitize_emoji(reaction))
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-add-reaction", guild_id=inter.guild.id).format(
@@ -671,7 +671,7 @@ class Message(commands.Cog):
                 )
                 try:
                     # We remove the db entry since the edit failed
-                    react = self.bot.db.remove_reaction(message_to_edit.id, sanitize_emoji(reaction))
+                    react = await self.bot.db.remove_reaction(message_to_edit.id, sanitize_emoji(reaction))
                 except DatabaseError as error:
                     await self.bot.report(
                         self.bot.response.get("db-error-remove-reaction", guild_id=inter.guild.id).format(
@@ -701,7 +701,7 @@ class Message(commands.Cog):
                 return
 
             try:
-                react = self.bot.db.remove_reaction(message_to_edit.id, sanitize_emoji(reaction))
+                react = await self.bot.db.remove_reaction(message_to_edit.id, sanitize_emoji(reaction))
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-remove-reaction", guild_id=inter.guild.id).format(
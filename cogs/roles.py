@@ -22,134 +22,215 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
+from functools import partial
 from sqlite3 import Error as DatabaseError
+from typing import Dict, List, Optional
 import disnake
 from disnake.ext import commands
 
+from cogs.utils.database import ResolvedReaction
 from cogs.utils.locks import lock_manager
+from cogs.utils.notifications import Notification, NotificationDispatcher
+from cogs.utils.pipeline import EventPipeline
+from cogs.utils.roleedits import RoleEditCoalescer
 
 
 class Roles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # Running selection backfills by message id, concurrent first reactions wait for the same one
+        self.backfills = {}
+        # Permission error reports started from role edit callbacks
+        self.reports = set()
+        # Role changes of a member within the window are applied together
+        self.role_edits = RoleEditCoalescer(self.bot.config.role_edit_window_ms / 1000)
+        # Role change DMs are collapsed per user and sent in the background
+        self.notifications = NotificationDispatcher(
+            self.send_notification,
+            window=self.bot.config.notify_window_ms / 1000,
+            queue_size=self.bot.config.notify_queue_size,
+            workers=self.bot.config.notify_workers,
+            rate=self.bot.config.notify_rate,
+            retries=self.bot.config.notify_retries,
+        )
+
+        # Reaction events are handled by a fixed pool of workers that serves the guilds in turn
+        self.pipeline = EventPipeline(
+            workers=self.bot.config.event_workers,
+            guild_queue_size=self.bot.config.event_guild_queue_size,
+            guild_concurrency=self.bot.config.event_guild_concurrency,
+            drop_policy=self.bot.config.event_drop_policy,
+        )
+
+    def cog_unload(self):
+        self.pipeline.stop()
+        self.notifications.stop()
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: disnake.RawReactionActionEvent):
+        if payload.user_id == self.bot.user.id or not self.bot.db.exists(payload.message_id):
+            # Ignores the bot's own reactions and messages that are not reaction-role messages managed by the bot
+            return
+
+        self.pipeline.submit(payload.guild_id, self.reaction_added, payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: disnake.RawReactionActionEvent):
+        if not self.bot.db.exists(payload.message_id):
+            # Checks that the message that was unreacted to is a reaction-role message managed by the bot
+            return
+
+        self.pipeline.submit(payload.guild_id, self.reaction_removed, payload)
+
+    async def reaction_added(self, payload: disnake.RawReactionActionEvent):
         reaction = str(payload.emoji)
         sanitized_reaction = str(payload.emoji.id) if payload.emoji.is_custom_emoji() else payload.emoji.name
         msg_id = payload.message_id
         ch_id = payload.channel_id
         user_id = payload.user_id
         guild_id = payload.guild_id
-        try:
-            exists = self.bot.db.exists(msg_id)
-        except DatabaseError as error:
-            await self.bot.report(
-                self.bot.response.get("db-error-reaction-add", guild_id=guild_id).format(exception=error), guild_id
-            )
-            return
-        async with await lock_manager.get_lock(user_id):
-            if not exists:
-                # Checks that the message that was reacted to is a reaction-role message managed by the bot
-                return
+        async with lock_manager.get_lock(guild_id, msg_id, user_id):
             try:
-                reactions = self.bot.db.get_reactions(msg_id)
+                resolved = await self.resolve_reaction(msg_id, sanitized_reaction, guild_id)
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-reaction-get", guild_id=guild_id).format(exception=error), guild_id
                 )
                 return
 
-            ch = await self.bot.getchannel(ch_id)
-            msg = await ch.fetch_message(msg_id)
-            user = await self.bot.getuser(user_id)
-            if sanitized_reaction not in reactions:
+            if resolved is None:
+                # The reaction-role message was deleted in the meantime
+                return
+
+            # Everything below works from the gateway payload and the cache, REST is only used to change reactions and roles
+            msg = self.bot.get_partial_messageable(ch_id).get_partial_message(msg_id)
+            user = disnake.Object(user_id)
+            if resolved.role_id is None:
                 # Removes reactions added to the reaction-role message that are not connected to any role
-                await msg.remove_reaction(reaction, user)
-            else:
-                # Gives role if it has permissions, else 403 error is raised
-                role_id = reactions[sanitized_reaction]
-                guild = await self.bot.getguild(guild_id)
-                member = await self.bot.getmember(guild, user_id)
-                role = disnake.utils.get(guild.roles, id=role_id)
-                if user_id != self.bot.user.id:
-                    try:
-                        unique = self.bot.db.isunique(msg_id)
-                    except DatabaseError as error:
-                        await self.bot.report(
-                            self.bot.response.get("db-error-reaction-unique", guild_id=guild_id).format(exception=error), guild_id
-                        )
-                        return
-                    if unique:
-                        for existing_reaction in msg.reactions:
-                            if str(existing_reaction.emoji) == reaction:
-                                continue
-                            reaction_users = await existing_reaction.users().flatten()
-                            reaction_users_ids = (reaction_user.id for reaction_user in reaction_users)
-                            if user_id in reaction_users_ids:
-                                await msg.remove_reaction(existing_reaction, user)
-                                # We can safely break since a user can only have one reaction at once
-                                break
-
-                    try:
-                        await member.add_roles(role)
-                        try:
-                            notify = self.bot.db.notify(guild_id)
-                        except DatabaseError as error:
-                            await self.bot.report(
-                                self.bot.response.get("db-error-notification-check", guild_id=guild_id).format(exception=error),
-                                guild_id,
-                            )
-                            return
-
-                        if notify:
-                            await user.send(self.bot.response.get("new-role-dm", guild_id=guild_id).format(role_name=role.name))
-                    except disnake.Forbidden:
-                        await self.bot.report(guild_id, self.bot.response.get("permission-error-add", guild_id=guild_id))
+                await msg.remove_reaction(payload.emoji, user)
+                return
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_remove(self, payload: disnake.RawReactionActionEvent):
+            guild = await self.bot.getguild(guild_id)
+            role = guild.get_role(resolved.role_id)
+            if role is None:
+                # The role was deleted from the guild
+                return
+
+            member = payload.member or await self.bot.getmember(guild, user_id)
+            if resolved.limit_to_one:
+                if self.bot.db.selections_tracked(msg_id):
+                    selection = self.bot.db.cached_selection(msg_id, user_id)
+                    if selection is None:
+                        selection = await self.bot.db.get_selection(msg_id, user_id)
+                    previous = [selection] if selection else []
+                else:
+                    previous = (await self.backfill_selections(msg)).get(user_id, [])
+                # Recorded first so the removal event of the previous reaction does not clear the new selection
+                await self.bot.db.set_selection(msg_id, user_id, reaction)
+                for previous_reaction in previous:
+                    if previous_reaction is not None and previous_reaction != reaction:
+                        await msg.remove_reaction(previous_reaction, user)
+
+            # Gives role if it has permissions, else 403 error is raised
+            # Not awaited: the worker moves on while the user's next reactions can still join the same role edit
+            self.role_edits.add(member, role).add_done_callback(
+                partial(self.role_edited, guild_id, user_id, role, True, resolved)
+            )
+
+    async def reaction_removed(self, payload: disnake.RawReactionActionEvent):
         sanitized_reaction = str(payload.emoji.id) if payload.emoji.is_custom_emoji() else payload.emoji.name
         msg_id = payload.message_id
         user_id = payload.user_id
         guild_id = payload.guild_id
-        try:
-            exists = self.bot.db.exists(msg_id)
-        except DatabaseError as error:
-            await self.bot.report(
-                self.bot.response.get("db-error-reaction-remove", guild_id=guild_id).format(exception=error), guild_id
-            )
-        if not exists:
-            # Checks that the message that was unreacted to is a reaction-role message managed by the bot
-            return
-        try:
-            reactions = self.bot.db.get_reactions(msg_id)
-        except DatabaseError as error:
-            await self.bot.report(
-                guild_id, self.bot.response.get("db-error-reaction-get", guild_id=guild_id).format(exception=error)
-            )
-            return
-        if sanitized_reaction in reactions:
-            role_id = reactions[sanitized_reaction]
-            # Removes role if it has permissions, else 403 error is raised
-            guild = await self.bot.getguild(guild_id)
-            member = await self.bot.getmember(guild, user_id)
-
-            role = disnake.utils.get(guild.roles, id=role_id)
+        # The same lock as reaction_added: the pipeline may run a user's add and remove on a message at the same time, and
+        # the role edits have to reach the coalescer in the order the reactions were made. Both handlers take the lock
+        # before their first await and the pipeline starts a guild's events in order, so the FIFO lock keeps that order
+        async with lock_manager.get_lock(guild_id, msg_id, user_id):
             try:
-                await member.remove_roles(role)
-                try:
-                    notify = self.bot.db.notify(guild_id)
-                except DatabaseError as error:
-                    await self.bot.report(
-                        self.bot.response.get("db-error-notification-check", guild_id=guild_id).format(exception=error), guild_id
-                    )
+                resolved = await self.resolve_reaction(msg_id, sanitized_reaction, guild_id)
+                if resolved is not None and resolved.limit_to_one:
+                    await self.bot.db.clear_selection(msg_id, user_id, str(payload.emoji))
+            except DatabaseError as error:
+                await self.bot.report(
+                    self.bot.response.get("db-error-reaction-get", guild_id=guild_id).format(exception=error), guild_id
+                )
+                return
+            if resolved is not None and resolved.role_id is not None:
+                # Removes role if it has permissions, else 403 error is raised
+                guild = await self.bot.getguild(guild_id)
+                role = guild.get_role(resolved.role_id)
+                if role is None:
+                    # The role was deleted from the guild
                     return
 
-                if notify:
-                    await member.send(self.bot.response.get("removed-role-dm", guild_id=guild_id).format(role_name=role.name))
-            except disnake.Forbidden:
-                await self.bot.report(self.bot.response.get("permission-error-remove", guild_id=guild_id), guild_id)
+                member = await self.bot.getmember(guild, user_id)
+                self.role_edits.remove(member, role).add_done_callback(
+                    partial(self.role_edited, guild_id, user_id, role, False, resolved)
+                )
+
+    async def resolve_reaction(self, msg_id: int, reaction: str, guild_id: int) -> Optional[ResolvedReaction]:
+        # Answered from memory on the event loop when possible, the database worker is only waited on for a cache miss
+        resolved = self.bot.db.cached_resolve_reaction(msg_id, reaction, guild_id)
+        if resolved is None:
+            resolved = await self.bot.db.resolve_reaction(msg_id, reaction, guild_id)
+        return resolved
+
+    def role_edited(
+        self, guild_id: int, user_id: int, role: disnake.Role, added: bool, resolved: ResolvedReaction, role_edit: asyncio.Future
+    ):
+        # Called once the coalesced role edit was applied (or found unnecessary)
+        if role_edit.cancelled():
+            # The cog is being unloaded
+            return
+        try:
+            if role_edit.result() and resolved.notify:
+                self.notifications.notify(user_id, guild_id, role, added, resolved.language)
+        except disnake.Forbidden:
+            error = "permission-error-add" if added else "permission-error-remove"
+            # The event loop only keeps weak references to tasks
+            report = asyncio.create_task(self.bot.report(self.bot.response.get_in(resolved.language, error), guild_id))
+            self.reports.add(report)
+            report.add_done_callback(self.reports.discard)
+        except disnake.HTTPException as error:
+            print(f"Could not {'add' if added else 'remove'} role {role.id} for user {user_id}: {error}")
+
+    async def send_notification(self, notification: Notification):
+        # One DM with every role the user gained or lost, in the guild's language
+        lines = [
+            self.bot.response.get_in(notification.language, "new-role-dm").format(role_name=role_name)
+            for role_name in notification.added
+        ]
+        lines += [
+            self.bot.response.get_in(notification.language, "removed-role-dm").format(role_name=role_name)
+            for role_name in notification.removed
+        ]
+        user = await self.bot.getuser(notification.user_id)
+        await user.send("\n".join(lines))
+
+    async def backfill_selections(self, msg: disnake.PartialMessage) -> Dict[int, List[str]]:
+        # Pages through the users of every reaction once to record who picked what on a message that predates selection tracking
+        # Runs once per message, every later reaction is a lookup in the selections table
+        if msg.id not in self.backfills:
+            self.backfills[msg.id] = asyncio.create_task(self.read_selections(msg))
+            self.backfills[msg.id].add_done_callback(lambda _: self.backfills.pop(msg.id, None))
+        return await asyncio.shield(self.backfills[msg.id])
+
+    async def read_selections(self, msg: disnake.PartialMessage) -> Dict[int, List[str]]:
+        # Returns every reaction of every user, only the first one is recorded for users that have several
+        # Cached messages have their reactions kept up to date by the gateway
+        full_msg = self.bot.get_message(msg.id) or await msg.fetch()
+        reactions_by_user = {}
+        for existing_reaction in full_msg.reactions:
+            if existing_reaction.count <= existing_reaction.me:
+                # Nobody but the bot added it
+                continue
+            async for reaction_user in existing_reaction.users():
+                if reaction_user.id != self.bot.user.id:
+                    reactions_by_user.setdefault(reaction_user.id, []).append(str(existing_reaction.emoji))
+
+        await self.bot.db.backfill_selections(msg.id, {user_id: reactions[0] for user_id, reactions in reactions_by_user.items()})
+        return reactions_by_user
 
 
 def setup(bot):
@@ -59,21 +59,18 @@ class Settings(commands.Cog):
             description=static_response.get("settings-systemchannel-option-channel"), default=None
         ),
     ):
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             await inter.send(content=self.bot.response.get("not-admin", guild_id=inter.guild.id))
             return
 
         await inter.response.defer()
         if not channel or channel_type not in ("main", "server"):
             try:
-                server_channel = self.bot.db.fetch_systemchannel(inter.guild.id)
+                server_channel = await self.bot.db.fetch_systemchannel(inter.guild.id)
             except DatabaseError as error:
                 await self.bot.report(self.bot.response.get("db-error-fetching-systemchannels").format(exception=error))
                 return
 
-            if server_channel:
-                server_channel = server_channel[0][0]
-
             main_text = (
                 (await self.bot.getchannel(self.bot.config.system_channel)).mention if self.bot.config.system_channel else "none"
             )
@@ -97,7 +94,7 @@ class Settings(commands.Cog):
             self.bot.config.update("server", "system_channel", str(channel.id))
         elif channel_type == "server":
             try:
-                self.bot.db.add_systemchannel(inter.guild.id, channel.id)
+                await self.bot.db.add_systemchannel(inter.guild.id, channel.id)
             except DatabaseError as error:
                 await self.bot.report(
                     self.bot.response.get("db-error-adding-systemchannels", guild_id=inter.guild.id).format(exception=error),
@@ -110,12 +107,12 @@ class Settings(commands.Cog):
     @settings_group.sub_command(name="notify", description=static_response.get("brief-settings-notify"))
     @commands.guild_only()
     async def toggle_notify(self, inter):
-        if not self.bot.isadmin(inter.author, inter.guild.id):
+        if not await self.bot.isadmin(inter.author, inter.guild.id):
             return
 
         await inter.response.defer()
         try:
-            notify = self.bot.db.toggle_notify(inter.guild.id)
+            notify = await self.bot.db.toggle_notify(inter.guild.id)
         except DatabaseError as error:
             await self.bot.report(
                 self.bot.response.get("db-error-toggle-notify", guild_id=inter.guild.id).format(exception=error), inter.guild.id
@@ -143,10 +140,10 @@ class Settings(commands.Cog):
                 await inter.send(content=self.bot.response.get("no-dm-parameters").format(parameters="server"))
                 return
             # Check admin
-            if not self.bot.isadmin(inter.author, inter.guild.id):
+            if not await self.bot.isadmin(inter.author, inter.guild.id):
                 await inter.send(content=self.bot.response.get("not-admin", guild_id=inter.guild.id))
                 return
-            self.bot.db.set_language(inter.guild.id, language)
+            await self.bot.db.set_language(inter.guild.id, language)
         else:
             # Check if bot owner
             if not await self.bot.is_owner(inter.author):
@@ -0,0 +1,157 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+from datetime import datetime
+import os
+import sqlite3
+from typing import List
+
+# Backup methods, "online" copies the live file page by page and "vacuum" writes a compacted snapshot with VACUUM INTO
+METHODS = ("online", "vacuum")
+
+
+class BackupError(Exception):
+    pass
+
+
+def verify(path: str):
+    # Raises BackupError unless the file at path is a readable, consistent SQLite database
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA integrity_check;").fetchall()
+    except sqlite3.DatabaseError as error:
+        raise BackupError(f"{path} is not a valid database: {error}") from error
+    finally:
+        conn.close()
+
+    if result != [("ok",)]:
+        raise BackupError(f"{path} failed the integrity check: {result[0][0]}")
+
+
+class BackupManager:
+    """Hot backups of the live database with rotating retention.
+
+    Backups only read the database through their own connection, so they can run on any thread while the bot keeps writing.
+    """
+
+    def __init__(self, database: str, directory: str, keep: int = 7, pages: int = 1024, sleep: float = 0.005):
+        self.database = database
+        self.directory = directory
+        self.keep = keep
+        # Pages copied per step of an online backup and the pause between steps, which lets the bot's writes through
+        self.pages = pages
+        self.sleep = sleep
+        self.prefix = os.path.splitext(os.path.basename(database))[0]
+
+    def backups(self) -> List[str]:
+        # Existing backups, oldest first
+        if not os.path.isdir(self.directory):
+            return []
+
+        names = [name for name in os.listdir(self.directory) if name.startswith(f"{self.prefix}-") and name.endswith(".db")]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def create(self, method: str = "online") -> str:
+        # Writes a verified backup and returns its path, the file only appears once it is complete
+        if method not in METHODS:
+            raise ValueError(f"Invalid backup method: {method}")
+
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.directory, f"{self.prefix}-{timestamp}.db")
+        partial = f"{path}.partial"
+        source = sqlite3.connect(self.database, isolation_level=None)
+        try:
+            if method == "online" and source.execute("PRAGMA journal_mode;").fetchone()[0] != "wal":
+                # Outside of WAL mode the read transaction pinning the snapshot would block the bot's writes for the whole
+                # paced copy, a single VACUUM INTO pass keeps that lock as short as possible
+                method = "vacuum"
+
+            if method == "vacuum":
+                source.execute("VACUUM INTO ?;", (partial,))
+            else:
+                # Holding a read transaction pins one snapshot of the database, otherwise every write the bot
+                # commits during the copy would restart it from the first page. Under WAL the bot keeps writing meanwhile
+                source.execute("BEGIN;")
+                source.execute("SELECT COUNT(*) FROM sqlite_master;").fetchall()
+                target = sqlite3.connect(partial)
+                try:
+                    source.backup(target, pages=self.pages, sleep=self.sleep)
+                finally:
+                    target.close()
+                source.execute("COMMIT;")
+
+            verify(partial)
+            os.replace(partial, path)
+        finally:
+            source.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self.rotate()
+        return path
+
+    def rotate(self) -> List[str]:
+        # Deletes all but the newest `keep` backups and returns the deleted paths
+        backups = self.backups()
+        expired = backups[: max(len(backups) - self.keep, 0)]
+        for path in expired:
+            os.remove(path)
+        return expired
+
+
+def restore(backup: str, database: str):
+    # Replaces the contents of database with a verified backup, the bot must not be running
+    verify(backup)
+    source = sqlite3.connect(f"file:{backup}?mode=ro", uri=True)
+    target = sqlite3.connect(database)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+if __name__ == "__main__":
+    directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    database = f"{directory}/files/reactionlight.db"
+    parser = argparse.ArgumentParser(description="Back up or restore the Reaction Light database.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    create_parser = subparsers.add_parser("create", help="write a new backup to files/backups")
+    create_parser.add_argument("--method", choices=METHODS, default="online")
+    create_parser.add_argument("--keep", type=int, default=7, help="number of backups to retain")
+    subparsers.add_parser("list", help="list the existing backups")
+    restore_parser = subparsers.add_parser("restore", help="overwrite the database with a backup (stop the bot first)")
+    restore_parser.add_argument("backup", help="path of the backup to restore")
+    args = parser.parse_args()
+
+    if args.action == "create":
+        print(BackupManager(database, f"{directory}/files/backups", keep=args.keep).create(args.method))
+    elif args.action == "list":
+        for path in BackupManager(database, f"{directory}/files/backups").backups():
+            print(path)
+    else:
+        restore(args.backup, database)
+        print(f"Restored {args.backup} to {database}")
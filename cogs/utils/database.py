@@ -22,372 +22,812 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from typing import Dict, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import inspect
+from itertools import islice
+from threading import RLock, Timer
+from time import perf_counter
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 import sqlite3
-from random import randint
+from cogs.utils.cache import LRUCache
+from cogs.utils.instrumentation import Instrumentation
 
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
 
-def initialize(database):
-    conn = sqlite3.connect(database)
-    cursor = conn.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'messages' ('message_id' INT, 'channel' INT, 'guild_id' INT, 'limit_to_one' INT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'reactionroles' ('message_id' INT, 'reaction' NVCARCHAR, 'role_id' INT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'admins' ('role_id' INT, 'guild_id' INT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'cleanup_queue_guilds' ('guild_id' INT, 'unix_timestamp' INT);")
+
+# Version of the layout created by initialize, SchemaHandler migrates older databases up to it
+SCHEMA_VERSION = 11
+
+
+def initialize(cursor):
+    # New databases are created with the current layout, existing ones are brought up to date by SchemaHandler
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages';")
+    new_database = not cursor.fetchall()
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS 'messages' ('message_id' INTEGER PRIMARY KEY, 'channel' INTEGER NOT NULL,"
+        " 'guild_id' INTEGER, 'limit_to_one' INTEGER NOT NULL DEFAULT 0);"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS 'reactionroles' ('message_id' INTEGER NOT NULL"
+        " REFERENCES messages (message_id) ON DELETE CASCADE, 'reaction' TEXT NOT NULL, 'role_id' INTEGER NOT NULL,"
+        " PRIMARY KEY (message_id, reaction)) WITHOUT ROWID;"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS 'admins' ('role_id' INTEGER NOT NULL, 'guild_id' INTEGER NOT NULL,"
+        " PRIMARY KEY (guild_id, role_id)) WITHOUT ROWID;"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS 'cleanup_queue_guilds' ('guild_id' INTEGER PRIMARY KEY, 'unix_timestamp' INTEGER NOT NULL);"
+    )
     cursor.execute("CREATE TABLE IF NOT EXISTS 'dbinfo' ('version' INT);")
     cursor.execute(
-        "CREATE TABLE IF NOT EXISTS 'guild_settings' ('guild_id' INT, 'notify' INT, 'systemchannel' INT, 'language' TEXT NULL);"
+        "CREATE TABLE IF NOT EXISTS 'guild_settings' ('guild_id' INTEGER PRIMARY KEY, 'notify' INTEGER NOT NULL DEFAULT 0,"
+        " 'systemchannel' INTEGER NOT NULL DEFAULT 0, 'language' TEXT NULL);"
     )
-    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS guild_id_idx ON guild_settings (guild_id);")
-    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS message_idx ON messages (message_id);")
-    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS guild_id_index ON cleanup_queue_guilds (guild_id);")
-    conn.commit()
+    if new_database:
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_channel_idx ON messages (channel);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages (guild_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS cleanup_queue_guilds_timestamp_idx ON cleanup_queue_guilds (unix_timestamp);")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS 'selections' ('message_id' INTEGER NOT NULL"
+            " REFERENCES messages (message_id) ON DELETE CASCADE, 'user_id' INTEGER NOT NULL, 'reaction' TEXT NOT NULL,"
+            " PRIMARY KEY (message_id, user_id)) WITHOUT ROWID;"
+        )
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS 'selection_backfills' ('message_id' INTEGER PRIMARY KEY"
+            " REFERENCES messages (message_id) ON DELETE CASCADE);"
+        )
+        # Nothing to migrate
+        cursor.execute("INSERT INTO dbinfo (version) VALUES (?);", (SCHEMA_VERSION,))
+
+
+def connect(database, journal_mode="wal", synchronous="normal", cache_size=-16000, mmap_size=268435456, busy_timeout=5000):
+    # Opens a connection tuned with the given PRAGMAs
+    # Transactions are handled explicitly (isolation_level=None) so that several statements can share one commit
+    journal_mode = journal_mode.lower()
+    synchronous = synchronous.lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Invalid journal_mode: {journal_mode}")
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous mode: {synchronous}")
+
+    conn = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+    cursor = conn.cursor()
+    # Only applies to new databases and has to come before anything writes to the file, existing ones are switched by SchemaHandler
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    cursor.execute(f"PRAGMA journal_mode = {journal_mode};")
+    cursor.execute(f"PRAGMA synchronous = {synchronous};")
+    cursor.execute(f"PRAGMA cache_size = {int(cache_size)};")
+    cursor.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    cursor.execute(f"PRAGMA busy_timeout = {int(busy_timeout)};")
+    cursor.execute("PRAGMA temp_store = MEMORY;")
+    # Deleting a message also deletes its reactionroles and selections rows
+    cursor.execute("PRAGMA foreign_keys = ON;")
     cursor.close()
-    conn.close()
+    return conn
+
+
+# Lookups answered from memory without a query, cheap enough to call directly on the event loop
+MEMORY_ONLY = (
+    "exists",
+    "selections_tracked",
+    "cached_resolve_reaction",
+    "cached_selection",
+    "cached_guild_settings",
+    "cached_admins",
+    "cleanup_queued",
+)
+# Context managers and teardown, the methods calling them are measured instead
+# The memory-only lookups run for nearly every gateway event, measuring them would cost more than the lookup
+UNINSTRUMENTED = ("cursor", "transaction", "close") + MEMORY_ONLY
 
 
 class DuplicateInstance(Exception):
     pass
 
 
+class ReactionRoleMessage(NamedTuple):
+    channel_id: int
+    guild_id: Optional[int]
+    limit_to_one: int
+    # Sanitized reaction -> role id
+    reactions: Dict[str, int]
+
+
+class GuildSettings(NamedTuple):
+    # SQLite doesn't support booleans
+    # INTs are used: 1 = True, 0 = False
+    notify: int
+    # 0 if not set
+    systemchannel: int
+    # None to use the global language
+    language: Optional[str]
+
+
+DEFAULT_GUILD_SETTINGS = GuildSettings(notify=0, systemchannel=0, language=None)
+
+# Cached for users known to have no reaction on a limit_to_one message
+NO_SELECTION = ""
+
+
+class ResolvedReaction(NamedTuple):
+    # None if the reaction is not linked to a role
+    role_id: Optional[int]
+    limit_to_one: int
+    notify: int
+    language: Optional[str]
+
+
 class Database:
-    def __init__(self, database):
+    def __init__(
+        self,
+        database,
+        guild_settings_cache_size=10000,
+        admins_cache_size=10000,
+        selections_cache_size=50000,
+        batch_window: float = 0,
+        batch_size: int = 100,
+        slow_query_ms: float = 100,
+        slow_query_log_size: int = 100,
+        **settings,
+    ):
+        # settings are forwarded to connect() (journal_mode, synchronous, cache_size, mmap_size, busy_timeout)
         self.database = database
-        initialize(self.database)
+        # Every public method is measured, see Instrumentation.report() for the results
+        self.instrumentation = Instrumentation(slow_query_ms, slow_query_log_size)
+        for name in dir(type(self)):
+            if not name.startswith("_") and name not in UNINSTRUMENTED and inspect.isfunction(getattr(type(self), name)):
+                setattr(self, name, self.instrumentation.wrap(name, getattr(self, name)))
+
+        # A single long-lived connection shared by every query, guarded by a reentrant lock
+        self.conn = connect(self.database, **settings)
+        self.lock = RLock()
+
+        # Group commit: batched writes are committed together once batch_window seconds passed
+        # or batch_size writes are pending, whichever comes first (a batch_window of 0 disables it)
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.pending_writes = 0
+        self.batch_timer: Optional[Timer] = None
+
+        with self.transaction() as cursor:
+            initialize(cursor)
 
         self.reactionrole_creation = {}
 
-        self.languages_cache: Dict[int, Optional[str]] = {}
+        # In-memory copy of the messages and reactionroles tables keyed by message id, kept current by every write
+        self.reactionroles_cache: Dict[int, ReactionRoleMessage] = {}
+        # guild_settings rows, bulk loaded at startup and kept current by the setters
+        self.guild_settings_cache = LRUCache(guild_settings_cache_size)
+        # Admin role ids per guild, filled on first use and invalidated by every change
+        self.admins_cache = LRUCache(admins_cache_size)
+        # Reaction picked by each user on limit_to_one messages, keyed by (message id, user id), NO_SELECTION if none
+        self.selections_cache = LRUCache(selections_cache_size)
+        # limit_to_one messages whose selections table rows cover every user, loaded with the reaction-role index
+        self.tracked_selections: Set[int] = set()
+        # Ids of the guilds in cleanup_queue_guilds, kept current by every write to it
+        self.cleanup_guilds: Set[int] = set()
+        try:
+            self.load_caches()
+        except sqlite3.OperationalError:
+            # The schema predates reactionroles.message_id or guild_settings.language,
+            # the caches are loaded again once it is migrated
+            pass
+
+    @contextmanager
+    def _locked(self):
+        # Takes the connection lock, charging the time spent waiting for it to the calling method
+        started = perf_counter()
+        with self.lock:
+            self.instrumentation.lock_waited(perf_counter() - started)
+            yield
+
+    @contextmanager
+    def cursor(self):
+        # Yields a cursor for read-only queries
+        with self._locked():
+            cursor = self.conn.cursor(self.instrumentation.cursor_factory)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def transaction(self, batch=False):
+        # Yields a cursor inside a transaction that is committed on success and rolled back on error
+        # With batch=True the commit may be deferred and shared with other batched writes
+        # Every write runs in its own savepoint so a failure never discards the pending batch
+        with self._locked():
+            cursor = self.conn.cursor(self.instrumentation.cursor_factory)
+            if not self.conn.in_transaction:
+                cursor.execute("BEGIN;")
+            cursor.execute("SAVEPOINT operation;")
+            try:
+                yield cursor
+            except BaseException:
+                if self.conn.in_transaction:
+                    cursor.execute("ROLLBACK TO operation;")
+                    cursor.execute("RELEASE operation;")
+                    if not self.pending_writes:
+                        self.conn.rollback()
+                else:
+                    # SQLite already rolled the whole transaction back
+                    self.pending_writes = 0
+                raise
+            else:
+                cursor.execute("RELEASE operation;")
+                if batch and self.batch_window:
+                    self.pending_writes += 1
+                    if self.pending_writes >= self.batch_size:
+                        self.flush()
+                    elif self.batch_timer is None:
+                        self.batch_timer = Timer(self.batch_window, self.flush)
+                        self.batch_timer.daemon = True
+                        self.batch_timer.start()
+                else:
+                    # Also makes the pending batched writes durable
+                    self.flush()
+            finally:
+                cursor.close()
+
+    def flush(self):
+        # Commits the pending batched writes, call it when a write has to be durable before going on
+        with self._locked():
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        with self._locked():
+            self.flush()
+            self.conn.close()
+
+    def load_caches(self):
+        self.load_reactionroles()
+        self.load_guild_settings()
+        self.load_cleanup_guilds()
+
+    def load_reactionroles(self):
+        # Builds the reaction-role index from the database
+        reactionroles = {}
+        with self.cursor() as cursor:
+            cursor.execute("SELECT message_id, channel, guild_id, limit_to_one FROM messages;")
+            for message_id, channel_id, guild_id, limit_to_one in cursor:
+                reactionroles[message_id] = ReactionRoleMessage(channel_id, guild_id, limit_to_one, {})
+
+            cursor.execute("SELECT message_id, reaction, role_id FROM reactionroles;")
+            for message_id, reaction, role_id in cursor:
+                if message_id in reactionroles:
+                    reactionroles[message_id].reactions[reaction] = role_id
+
+            cursor.execute("SELECT message_id FROM selection_backfills;")
+            tracked_selections = {row[0] for row in cursor}
+
+        self.reactionroles_cache = reactionroles
+        self.tracked_selections = tracked_selections
+
+    def load_guild_settings(self):
+        # Loads every guild_settings row (up to the cache size) in one query
+        guild_settings = LRUCache(self.guild_settings_cache.maxsize)
+        with self.cursor() as cursor:
+            cursor.execute("SELECT guild_id, notify, systemchannel, language FROM guild_settings;")
+            for guild_id, notify, systemchannel, language in cursor:
+                guild_settings.put(guild_id, GuildSettings(notify or 0, systemchannel or 0, language))
+
+        self.guild_settings_cache = guild_settings
+
+    def load_cleanup_guilds(self):
+        # The cleanup queue only holds guilds the bot left, small enough to keep every id in memory
+        with self.cursor() as cursor:
+            cursor.execute("SELECT guild_id FROM cleanup_queue_guilds;")
+            self.cleanup_guilds = {row[0] for row in cursor}
+
+    @property
+    def guild_settings_complete(self):
+        # While nothing was evicted every guild_settings row is cached, a miss then means the guild uses the defaults
+        return self.guild_settings_cache.evictions == 0
+
+    def get_guild_settings(self, guild_id: int) -> GuildSettings:
+        # Never writes: guilds without a guild_settings row get the defaults
+        settings = self.guild_settings_cache.get(guild_id)
+        if settings is not None:
+            return settings
+        if self.guild_settings_complete:
+            return DEFAULT_GUILD_SETTINGS
+
+        with self.cursor() as cursor:
+            cursor.execute("SELECT notify, systemchannel, language FROM guild_settings WHERE guild_id = ?;", (guild_id,))
+            result = cursor.fetchone()
+
+        settings = GuildSettings(result[0] or 0, result[1] or 0, result[2]) if result else DEFAULT_GUILD_SETTINGS
+        self.guild_settings_cache.put(guild_id, settings)
+        return settings
+
+    def _update_guild_settings(self, guild_id: int, **changes):
+        # Upserts the given guild_settings columns and updates the cache
+        columns = ", ".join(changes)
+        placeholders = ", ".join("?" for _ in changes)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in changes)
+        with self.transaction(batch=True) as cursor:
+            settings = self.get_guild_settings(guild_id)._replace(**changes)
+            cursor.execute(
+                f"INSERT INTO guild_settings (guild_id, {columns}) VALUES (?, {placeholders})"
+                f" ON CONFLICT (guild_id) DO UPDATE SET {updates};",
+                (guild_id, *changes.values()),
+            )
+            self.guild_settings_cache.put(guild_id, settings)
+        return settings
 
     def add_reaction_role(self, rl_dict: dict):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
         if self.exists(rl_dict["message"]["message_id"]):
             raise DuplicateInstance("The message id is already in use!")
-        cursor.execute(
-            "INSERT INTO 'messages' ('message_id', 'channel', 'guild_id', 'limit_to_one') values(?, ?, ?, ?);",
-            (
-                rl_dict["message"]["message_id"],
-                rl_dict["message"]["channel_id"],
-                rl_dict["message"]["guild_id"],
-                rl_dict["limit_to_one"],
-            ),
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO 'messages' ('message_id', 'channel', 'guild_id', 'limit_to_one') values(?, ?, ?, ?);",
+                (
+                    rl_dict["message"]["message_id"],
+                    rl_dict["message"]["channel_id"],
+                    rl_dict["message"]["guild_id"],
+                    rl_dict["limit_to_one"],
+                ),
+            )
+            combos = [(rl_dict["message"]["message_id"], reaction, role_id) for reaction, role_id in rl_dict["reactions"].items()]
+            cursor.executemany("INSERT INTO 'reactionroles' ('message_id', 'reaction', 'role_id') values(?, ?, ?);", combos)
+            if rl_dict["limit_to_one"]:
+                # A new message has no selections yet, so there is nothing to backfill
+                cursor.execute("INSERT INTO selection_backfills (message_id) VALUES (?);", (rl_dict["message"]["message_id"],))
+
+        if rl_dict["limit_to_one"]:
+            self.tracked_selections.add(rl_dict["message"]["message_id"])
+        self.reactionroles_cache[rl_dict["message"]["message_id"]] = ReactionRoleMessage(
+            rl_dict["message"]["channel_id"],
+            rl_dict["message"]["guild_id"],
+            rl_dict["limit_to_one"],
+            dict(rl_dict["reactions"]),
         )
-        combos = [(rl_dict["message"]["message_id"], reaction, role_id) for reaction, role_id in rl_dict["reactions"].items()]
-        cursor.executemany("INSERT INTO 'reactionroles' ('message_id', 'reaction', 'role_id') values(?, ?, ?);", combos)
-        conn.commit()
-        cursor.close()
-        conn.close()
 
     def exists(self, message_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM messages WHERE message_id = ?;", (message_id,))
-        result = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return result
+        # Membership test against the reaction-role index, cheap enough to filter every reaction event
+        return message_id in self.reactionroles_cache
 
     def get_reactions(self, message_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT reaction, role_id FROM reactionroles WHERE message_id = ?;", (message_id,))
-        combos = {}
-        for row in cursor:
-            reaction = row[0]
-            role_id = row[1]
-            combos[reaction] = role_id
-
-        cursor.close()
-        conn.close()
-        return combos
+        message = self.reactionroles_cache.get(message_id)
+        return dict(message.reactions) if message else {}
 
     def isunique(self, message_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT limit_to_one FROM messages WHERE message_id = ?;", (message_id,))
-        unique = cursor.fetchall()[0][0]
-        cursor.close()
-        conn.close()
-        return unique
+        return self.reactionroles_cache[message_id].limit_to_one
+
+    def cached_resolve_reaction(self, message_id, reaction, guild_id) -> Optional[ResolvedReaction]:
+        # Memory only: what resolve_reaction returns, if both the message and the guild's settings are cached
+        message = self.reactionroles_cache.get(message_id)
+        settings = self.cached_guild_settings(guild_id)
+        if message is None or settings is None:
+            return None
+        return ResolvedReaction(message.reactions.get(reaction), message.limit_to_one, settings.notify, settings.language)
+
+    def resolve_reaction(self, message_id, reaction, guild_id) -> Optional[ResolvedReaction]:
+        # Everything the reaction listeners need, from memory or with a single query
+        # Returns None if the message is not a reaction-role message
+        resolved = self.cached_resolve_reaction(message_id, reaction, guild_id)
+        if resolved is not None:
+            return resolved
+
+        with self.cursor() as cursor:
+            cursor.execute(
+                "SELECT reactionroles.role_id, messages.limit_to_one,"
+                " guild_settings.notify, guild_settings.systemchannel, guild_settings.language"
+                " FROM messages"
+                " LEFT JOIN reactionroles ON reactionroles.message_id = messages.message_id AND reactionroles.reaction = ?"
+                " LEFT JOIN guild_settings ON guild_settings.guild_id = ?"
+                " WHERE messages.message_id = ?;",
+                (reaction, guild_id, message_id),
+            )
+            result = cursor.fetchone()
+
+        if result is None:
+            return None
+
+        role_id, limit_to_one, notify, systemchannel, language = result
+        # Guilds without a guild_settings row use the defaults
+        settings = GuildSettings(notify or 0, systemchannel or 0, language)
+        self.guild_settings_cache.put(guild_id, settings)
+        return ResolvedReaction(role_id, limit_to_one, settings.notify, settings.language)
+
+    def selections_tracked(self, message_id: int) -> bool:
+        # True once every user's selection on the limit_to_one message is recorded, see backfill_selections
+        return message_id in self.tracked_selections
+
+    def cached_selection(self, message_id: int, user_id: int) -> Optional[str]:
+        # Memory only: the user's selection if it is cached (NO_SELECTION if they have none), None otherwise
+        return self.selections_cache.get((message_id, user_id))
+
+    def get_selection(self, message_id: int, user_id: int) -> Optional[str]:
+        # The reaction the user currently has on a limit_to_one message, None if they have none
+        selection = self.cached_selection(message_id, user_id)
+        if selection is None:
+            with self.cursor() as cursor:
+                cursor.execute("SELECT reaction FROM selections WHERE message_id = ? AND user_id = ?;", (message_id, user_id))
+                result = cursor.fetchone()
+            selection = result[0] if result else NO_SELECTION
+            self.selections_cache.put((message_id, user_id), selection)
+        return selection or None
+
+    def set_selection(self, message_id: int, user_id: int, reaction: str):
+        with self.transaction(batch=True) as cursor:
+            cursor.execute(
+                "INSERT INTO selections (message_id, user_id, reaction) VALUES (?, ?, ?)"
+                " ON CONFLICT (message_id, user_id) DO UPDATE SET reaction = excluded.reaction;",
+                (message_id, user_id, reaction),
+            )
+        self.selections_cache.put((message_id, user_id), reaction)
+
+    def clear_selection(self, message_id: int, user_id: int, reaction: str):
+        # Forgets the user's selection if it still is the given reaction
+        with self.transaction(batch=True) as cursor:
+            cursor.execute(
+                "DELETE FROM selections WHERE message_id = ? AND user_id = ? AND reaction = ?;", (message_id, user_id, reaction)
+            )
+            if cursor.rowcount:
+                self.selections_cache.put((message_id, user_id), NO_SELECTION)
+
+    def backfill_selections(self, message_id: int, selections: Dict[int, str]):
+        # Records the selections found on a limit_to_one message that predates the selections table (user id -> reaction)
+        # Rows written since are newer and kept
+        with self.transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO selections (message_id, user_id, reaction) VALUES (?, ?, ?);",
+                ((message_id, user_id, reaction) for user_id, reaction in selections.items()),
+            )
+            cursor.execute("INSERT OR IGNORE INTO selection_backfills (message_id) VALUES (?);", (message_id,))
+        # Users cached as having no selection may have one now
+        for user_id in selections:
+            if self.selections_cache.get((message_id, user_id)) == NO_SELECTION:
+                self.selections_cache.pop((message_id, user_id))
+        self.tracked_selections.add(message_id)
 
     def fetch_messages(self, channel):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT message_id FROM messages WHERE channel = ?;", (channel,))
-        all_messages_in_channel = []
-        for row in cursor:
-            message_id = int(row[0])
-            all_messages_in_channel.append(message_id)
-
-        cursor.close()
-        conn.close()
+        with self.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM messages WHERE channel = ?;", (channel,))
+            all_messages_in_channel = []
+            for row in cursor:
+                message_id = int(row[0])
+                all_messages_in_channel.append(message_id)
+
         return all_messages_in_channel
 
     def fetch_all_messages(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM messages;")
-        all_messages = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
-        return all_messages
+        return list(self.iter_all_messages())
+
+    def _iter_pages(self, query: str, chunk_size: int) -> Iterator[tuple]:
+        # Streams the rows of a query keyed on its first column in pages of chunk_size rows.
+        # Every page is its own short query, so the lock is not held while the caller works through the rows
+        # and the caller can safely write to the table between pages.
+        last_key = 0
+        while True:
+            with self.cursor() as cursor:
+                cursor.execute(query, {"after": last_key, "limit": chunk_size})
+                rows = cursor.fetchall()
+
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            last_key = rows[-1][0]
+
+    def iter_all_messages(self, chunk_size: int = 500) -> Iterator[Tuple[int, int, int, int]]:
+        yield from self._iter_pages(
+            "SELECT * FROM messages WHERE message_id > :after ORDER BY message_id LIMIT :limit;", chunk_size
+        )
 
     def add_guild(self, channel_id, guild_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE messages SET guild_id = ? WHERE channel = ?;", (guild_id, channel_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction(batch=True) as cursor:
+            cursor.execute("UPDATE messages SET guild_id = ? WHERE channel = ?;", (guild_id, channel_id))
+
+        for message_id, message in self.reactionroles_cache.items():
+            if message.channel_id == channel_id:
+                self.reactionroles_cache[message_id] = message._replace(guild_id=guild_id)
 
     def remove_guild(self, guild_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        # Deleting the guilds reaction-role database entries
-        cursor.execute("SELECT message_id FROM messages WHERE guild_id = ?;", (guild_id,))
-        results = cursor.fetchall()
-        if results:
-            for result in results:
-                message_id = result[0]
-                cursor.execute("DELETE FROM messages WHERE message_id = ?;", (message_id,))
-                cursor.execute("DELETE FROM reactionroles WHERE message_id = ?;", (message_id,))
-        # Deleting the guilds guild_settings database entries
-        cursor.execute("DELETE FROM guild_settings WHERE guild_id = ?;", (guild_id,))
-        # Delete the guilds admin roles
-        cursor.execute("DELETE FROM admins WHERE guild_id = ?;", (guild_id,))
-        # Delete the guilds potencial cleanup_queue entries
-        cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id=?;", (guild_id,))
-        conn.commit()
-
-        cursor.close()
-        conn.close()
+        self.remove_guilds((guild_id,))
+
+    def remove_guilds(self, guild_ids: Iterable[int]):
+        # Purges every row of the given guilds with one set-based DELETE per table, all in a single transaction
+        guild_ids = set(guild_ids)
+        with self.transaction(batch=True) as cursor:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS purge_guilds ('guild_id' INTEGER PRIMARY KEY);")
+            cursor.executemany(
+                "INSERT OR IGNORE INTO purge_guilds (guild_id) VALUES (?);", ((guild_id,) for guild_id in guild_ids)
+            )
+            # Deleting the guilds reaction-role database entries
+            for table in ("reactionroles", "selections", "selection_backfills"):
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE message_id IN"
+                    " (SELECT message_id FROM messages WHERE guild_id IN (SELECT guild_id FROM purge_guilds));"
+                )
+            cursor.execute("DELETE FROM messages WHERE guild_id IN (SELECT guild_id FROM purge_guilds);")
+            # Deleting the guilds guild_settings database entries
+            cursor.execute("DELETE FROM guild_settings WHERE guild_id IN (SELECT guild_id FROM purge_guilds);")
+            # Delete the guilds admin roles
+            cursor.execute("DELETE FROM admins WHERE guild_id IN (SELECT guild_id FROM purge_guilds);")
+            # Delete the guilds potencial cleanup_queue entries
+            cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id IN (SELECT guild_id FROM purge_guilds);")
+            cursor.execute("DELETE FROM purge_guilds;")
+
+        removed = [message_id for message_id, message in self.reactionroles_cache.items() if message.guild_id in guild_ids]
+        for message_id in removed:
+            del self.reactionroles_cache[message_id]
+            self.tracked_selections.discard(message_id)
+        for guild_id in guild_ids:
+            self.guild_settings_cache.pop(guild_id)
+            self.admins_cache.pop(guild_id)
+            self.cleanup_guilds.discard(guild_id)
 
     def delete(self, message_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM messages WHERE message_id = ?;", (message_id,))
-        cursor.execute("DELETE FROM reactionroles WHERE message_id = ?;", (message_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction(batch=True) as cursor:
+            cursor.execute("DELETE FROM messages WHERE message_id = ?;", (message_id,))
+
+        self.reactionroles_cache.pop(message_id, None)
+        self.tracked_selections.discard(message_id)
 
     def add_admin(self, role_id: int, guild_id: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO 'admins' ('role_id', 'guild_id') values(?,?);", (role_id, guild_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO 'admins' ('role_id', 'guild_id') values(?,?);", (role_id, guild_id))
+        self.admins_cache.pop(guild_id)
 
     def remove_admin(self, role_id: int, guild_id: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM admins WHERE role_id = ? AND guild_id = ?;", (role_id, guild_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-    def get_admins(self, guild_id: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM admins WHERE guild_id = ?;", (guild_id,))
-        admins = []
-        for row in cursor:
-            role_id = row[0]
-            admins.append(role_id)
-
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM admins WHERE role_id = ? AND guild_id = ?;", (role_id, guild_id))
+        self.admins_cache.pop(guild_id)
+
+    def get_admins(self, guild_id: int) -> FrozenSet[int]:
+        admins = self.admins_cache.get(guild_id)
+        if admins is not None:
+            return admins
+
+        with self.cursor() as cursor:
+            cursor.execute("SELECT role_id FROM admins WHERE guild_id = ?;", (guild_id,))
+            admins = frozenset(row[0] for row in cursor)
+
+        self.admins_cache.put(guild_id, admins)
         return admins
 
-    def insert_guildsettings(self, guild_id: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        notify = 0
-        channel_id = 0
-        cursor.execute(
-            "INSERT OR IGNORE INTO guild_settings ('guild_id', 'notify', 'systemchannel') values(?, ?, ?);",
-            (guild_id, notify, channel_id),
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+    def cached_admins(self, guild_id: int) -> Optional[FrozenSet[int]]:
+        # Memory only: the guild's admin role ids if they are cached, None otherwise
+        return self.admins_cache.get(guild_id)
 
     def add_systemchannel(self, guild_id, channel_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        self.insert_guildsettings(guild_id)
-        cursor.execute("UPDATE guild_settings SET systemchannel = ? WHERE guild_id = ?;", (channel_id, guild_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        self._update_guild_settings(guild_id, systemchannel=channel_id)
 
     def remove_systemchannel(self, guild_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
         channel_id = 0  # Set to false
-        self.insert_guildsettings(guild_id)
-        cursor.execute("UPDATE guild_settings SET systemchannel = ? WHERE guild_id = ?;", (channel_id, guild_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        self._update_guild_settings(guild_id, systemchannel=channel_id)
 
     def fetch_systemchannel(self, guild_id):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT systemchannel FROM guild_settings WHERE guild_id = ?;", (guild_id,))
-        result = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return result
+        # Returns 0 if the guild has no system channel
+        return self.get_guild_settings(guild_id).systemchannel
 
     def fetch_all_guilds(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT guild_id FROM messages;")
-        message_guilds = cursor.fetchall()
-
-        cursor.execute("SELECT guild_id FROM guild_settings;")
-        systemchannel_guilds = cursor.fetchall()
-
-        cursor.execute("SELECT guild_id FROM admins;")
-        admin_guilds = cursor.fetchall()
-
-        guilds = message_guilds + systemchannel_guilds + admin_guilds
-
-        # Removes any duplicate guilds from the list
-        guilds = list(dict.fromkeys(guilds))
-        guild_ids = []
-        for guild in guilds:
-            if guild[0] is not None:
-                guild_ids.append(guild[0])
-
-        cursor.close()
-        conn.close()
-        return guild_ids
+        return list(self.iter_all_guilds())
+
+    def iter_all_guilds(self, chunk_size: int = 500) -> Iterator[int]:
+        # UNION removes duplicates in SQLite, merging the three guild_id indexes in order
+        rows = self._iter_pages(
+            "SELECT guild_id FROM messages WHERE guild_id > :after"
+            " UNION SELECT guild_id FROM guild_settings WHERE guild_id > :after"
+            " UNION SELECT guild_id FROM admins WHERE guild_id > :after"
+            " ORDER BY guild_id LIMIT :limit;",
+            chunk_size,
+        )
+        for row in rows:
+            yield row[0]
 
     def add_reaction(self, message_id, role_id, reaction):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM reactionroles WHERE message_id = ? AND reaction = ?;", (message_id, reaction))
-        exists = cursor.fetchall()
-        if exists:
-            cursor.close()
-            conn.close()
-            return False
-
-        cursor.execute(
-            "INSERT INTO reactionroles ('message_id', 'reaction', 'role_id') values(?, ?, ?);",
-            (message_id, reaction, role_id),
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO reactionroles ('message_id', 'reaction', 'role_id') values(?, ?, ?);",
+                (message_id, reaction, role_id),
+            )
+            if not cursor.rowcount:
+                # The reaction is already in use on this message
+                return False
+
+        if message_id in self.reactionroles_cache:
+            self.reactionroles_cache[message_id].reactions[reaction] = role_id
         return True
 
     def remove_reaction(self, message_id, reaction):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM reactionroles WHERE message_id = ? AND reaction = ?;", (message_id, reaction))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM reactionroles WHERE message_id = ? AND reaction = ?;", (message_id, reaction))
+
+        if message_id in self.reactionroles_cache:
+            self.reactionroles_cache[message_id].reactions.pop(reaction, None)
 
     def add_cleanup_guild(self, guild_id: int, unix_timestamp: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO 'cleanup_queue_guilds' ('guild_id', 'unix_timestamp') values(?,?);", (guild_id, unix_timestamp)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction(batch=True) as cursor:
+            cursor.execute(
+                "INSERT INTO 'cleanup_queue_guilds' ('guild_id', 'unix_timestamp') values(?,?);", (guild_id, unix_timestamp)
+            )
+        self.cleanup_guilds.add(guild_id)
         return True
 
     def remove_cleanup_guild(self, guild_id: int):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id=?;", (guild_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.transaction(batch=True) as cursor:
+            cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id=?;", (guild_id,))
+        self.cleanup_guilds.discard(guild_id)
         return True
 
+    def cleanup_queued(self, guild_id: int) -> bool:
+        # Memory only, lets callers skip the DELETE for the guilds that are not queued
+        return guild_id in self.cleanup_guilds
+
+    def sweep_orphans(self, guild_ids: Iterable[int]) -> Dict[str, int]:
+        # Deletes the reactionroles rows of deleted messages and the admins and guild_settings rows of guilds the bot is
+        # no longer in (guilds waiting in the cleanup queue are left to the cleaner), returns the rows deleted per table
+        guild_ids = set(guild_ids)
+        removed = {"reactionroles": 0, "admins": 0, "guild_settings": 0}
+        with self.transaction(batch=True) as cursor:
+            cursor.execute("DELETE FROM reactionroles WHERE message_id NOT IN (SELECT message_id FROM messages);")
+            removed["reactionroles"] = cursor.rowcount
+            # Without the bot's guilds every guild would look absent
+            if guild_ids:
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS present_guilds ('guild_id' INTEGER PRIMARY KEY);")
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO present_guilds (guild_id) VALUES (?);", ((guild_id,) for guild_id in guild_ids)
+                )
+                absent = (
+                    "guild_id NOT IN (SELECT guild_id FROM present_guilds)"
+                    " AND guild_id NOT IN (SELECT guild_id FROM cleanup_queue_guilds)"
+                )
+                cursor.execute(
+                    f"SELECT guild_id FROM admins WHERE {absent} UNION SELECT guild_id FROM guild_settings WHERE {absent};"
+                )
+                swept_guilds = [row[0] for row in cursor.fetchall()]
+                for table in ("admins", "guild_settings"):
+                    cursor.execute(f"DELETE FROM {table} WHERE {absent};")
+                    removed[table] = cursor.rowcount
+                cursor.execute("DELETE FROM present_guilds;")
+
+                for guild_id in swept_guilds:
+                    self.guild_settings_cache.pop(guild_id)
+                    self.admins_cache.pop(guild_id)
+
+        return removed
+
+    def optimize(self):
+        # Refreshes the statistics used by the query planner, a full ANALYZE the first time
+        with self.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1';")
+            cursor.execute("PRAGMA optimize;" if cursor.fetchall() else "ANALYZE;")
+
+    def free_pages(self) -> Tuple[int, int]:
+        # Number of unused pages in the file and the page size in bytes
+        with self.cursor() as cursor:
+            cursor.execute("PRAGMA freelist_count;")
+            free = cursor.fetchone()[0]
+            cursor.execute("PRAGMA page_size;")
+            return free, cursor.fetchone()[0]
+
+    def incremental_vacuum(self, pages: int = 256) -> int:
+        # Returns up to `pages` free pages to the file system, returns how many were released
+        with self.cursor() as cursor:
+            cursor.execute("PRAGMA auto_vacuum;")
+            if cursor.fetchone()[0] != 2:
+                return 0
+            # executescript steps the pragma to completion (execute only frees one page) but commits first
+            self.flush()
+            cursor.execute("PRAGMA freelist_count;")
+            before = cursor.fetchone()[0]
+            cursor.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            cursor.execute("PRAGMA freelist_count;")
+            return before - cursor.fetchone()[0]
+
+    def fetch_due_cleanup_guilds(self, unix_timestamp: int, limit: int = 100) -> List[Tuple[int, int]]:
+        # Oldest queued guilds that were queued at or before unix_timestamp
+        with self.cursor() as cursor:
+            cursor.execute(
+                "SELECT guild_id, unix_timestamp FROM cleanup_queue_guilds WHERE unix_timestamp <= ?"
+                " ORDER BY unix_timestamp LIMIT ?;",
+                (unix_timestamp, limit),
+            )
+            return cursor.fetchall()
+
+    def next_cleanup_timestamp(self) -> Optional[int]:
+        # Queue time of the oldest queued guild, None if the queue is empty
+        with self.cursor() as cursor:
+            cursor.execute("SELECT MIN(unix_timestamp) FROM cleanup_queue_guilds;")
+            return cursor.fetchone()[0]
+
     def fetch_cleanup_guilds(self, guild_ids_only=False):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
+        guilds = self.iter_cleanup_guilds()
         if guild_ids_only:
-            cursor.execute("SELECT guild_id FROM cleanup_queue_guilds;")
-            guilds = cursor.fetchall()
-            guild_ids = []
-            for guild in guilds:
-                guild_ids.append(guild[0])
-            guilds = guild_ids
-        else:
-            cursor.execute("SELECT * FROM cleanup_queue_guilds;")
-            guilds = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return guilds
+            return [guild[0] for guild in guilds]
+
+        return list(guilds)
+
+    def iter_cleanup_guilds(self, chunk_size: int = 500) -> Iterator[Tuple[int, int]]:
+        yield from self._iter_pages(
+            "SELECT * FROM cleanup_queue_guilds WHERE guild_id > :after ORDER BY guild_id LIMIT :limit;", chunk_size
+        )
 
     def toggle_notify(self, guild_id: int):
-        # SQLite doesn't support booleans
-        # INTs are used: 1 = True, 0 = False
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        self.insert_guildsettings(guild_id)
-        cursor.execute("SELECT notify FROM guild_settings WHERE guild_id = ?", (guild_id,))
-        results = cursor.fetchall()
-        notify = results[0][0]
-        notify = 0 if notify else 1
-        cursor.execute("UPDATE guild_settings SET notify = ? WHERE guild_id = ?", (notify, guild_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self._locked():
+            notify = 0 if self.get_guild_settings(guild_id).notify else 1
+            self._update_guild_settings(guild_id, notify=notify)
         return notify
 
     def notify(self, guild_id: int):
-        # SQLite doesn't support booleans
-        # INTs are used: 1 = True, 0 = False
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        self.insert_guildsettings(guild_id)
-        cursor.execute("SELECT notify FROM guild_settings WHERE guild_id = ?", (guild_id,))
-        results = cursor.fetchall()
-        notify = results[0][0]
-        cursor.close()
-        conn.close()
-        return notify
+        return self.get_guild_settings(guild_id).notify
 
     def set_language(self, guild_id: int, language: str):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        self.insert_guildsettings(guild_id)
-        cursor.execute("INSERT OR REPLACE INTO guild_settings (guild_id, language) VALUES (?, ?)", (guild_id, language))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        self.languages_cache[guild_id] = language
+        self._update_guild_settings(guild_id, language=language)
         return True
 
     def get_language(self, guild_id: int) -> Optional[str]:
-        if guild_id in self.languages_cache:
-            return self.languages_cache[guild_id]
-
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        self.insert_guildsettings(guild_id)
-        cursor.execute("SELECT language FROM guild_settings WHERE guild_id = ?", (guild_id,))
-        language = None
-        try:
-            language = cursor.fetchone()[0]
-        except KeyError:
-            pass
-        cursor.close()
-        conn.close()
+        return self.get_guild_settings(guild_id).language
+
+    def cached_guild_settings(self, guild_id: int) -> Optional[GuildSettings]:
+        # Memory only: the guild's settings if they are known without a query, None otherwise
+        settings = self.guild_settings_cache.get(guild_id)
+        if settings is None and self.guild_settings_complete:
+            return DEFAULT_GUILD_SETTINGS
+        return settings
+
+
+class AsyncDatabase:
+    """Awaitable version of Database that runs every query on a dedicated worker thread."""
 
-        self.languages_cache[guild_id] = language
+    # Methods answered from memory that are called directly (and synchronously) on the event loop
+    cached = MEMORY_ONLY
+    # Rows pulled from the worker thread at a time by the iter_* methods
+    chunk_size = 500
 
-        return language
+    def __init__(self, database: Database):
+        self.database = database
+        # A single worker keeps the queries serialised and in submission order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+    def __getattr__(self, name):
+        attribute = getattr(self.database, name)
+        if name in self.cached or not callable(attribute):
+            return attribute
+
+        if inspect.isgeneratorfunction(attribute):
+
+            async def stream_from_worker(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                rows = attribute(*args, **kwargs)
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, partial(list, islice(rows, self.chunk_size)))
+                    for row in chunk:
+                        yield row
+                    if len(chunk) < self.chunk_size:
+                        return
+
+            return stream_from_worker
+
+        async def run_in_worker(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(attribute, *args, **kwargs))
+
+        return run_in_worker
+
+    def get_language(self, guild_id: int) -> Optional[str]:
+        # Called on the event loop for every translated response, so it never waits for SQLite: on a cache miss the
+        # global language (None) is used this once while the worker loads the guild's settings into the cache
+        # Callers that can await load the settings first instead, see ReactionLight.load_language
+        settings = self.database.cached_guild_settings(guild_id)
+        if settings is None:
+            self.executor.submit(self.database.get_guild_settings, guild_id)
+            return None
+        return settings.language
+
+    def close(self):
+        # Lets the queued queries finish before closing the connection
+        self.executor.shutdown(wait=True)
+        self.database.close()
@@ -79,6 +79,10 @@ class Response(BaseResponse):
 
         return self._get_translation(language, item)
 
+    def get_in(self, language: Optional[str], item: str) -> str:
+        # For callers that already know the guild's language (None for the global language), skips the lookup
+        return self._get_translation(language if language else self.global_language, item)
+
 
 class StaticResponse(BaseResponse):
     """Get language keys without the context of a bot instance."""
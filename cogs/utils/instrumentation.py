@@ -0,0 +1,296 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+import functools
+import inspect
+from threading import Lock, local
+from time import perf_counter
+from typing import Dict, List, NamedTuple
+import json
+import sqlite3
+
+# Upper bounds (in milliseconds) of the latency histogram buckets, slower calls go into a final overflow bucket
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Call:
+    """Measurements of one method call, filled in by the cursors it uses."""
+
+    __slots__ = ("method", "elapsed", "rows", "lock_wait", "failed")
+
+    def __init__(self, method: str):
+        self.method = method
+        self.elapsed = 0.0
+        self.rows = 0
+        self.lock_wait = 0.0
+        self.failed = False
+
+
+class MethodStats:
+    __slots__ = ("calls", "errors", "total_time", "max_time", "rows", "lock_wait", "histogram")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.lock_wait = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, call: Call):
+        self.calls += 1
+        self.errors += call.failed
+        self.total_time += call.elapsed
+        self.max_time = max(self.max_time, call.elapsed)
+        self.rows += call.rows
+        self.lock_wait += call.lock_wait
+        self.histogram[bisect_left(LATENCY_BUCKETS_MS, call.elapsed * 1000)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the given fraction of the calls (the maximum for the overflow bucket)
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.histogram):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max_time * 1000
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / self.calls, 3) if self.calls else 0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_time * 1000, 3),
+            "rows": self.rows,
+            "lock_wait_ms": round(self.lock_wait * 1000, 3),
+            "histogram": dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"], self.histogram)),
+        }
+
+
+class SlowQuery(NamedTuple):
+    timestamp: str
+    method: str
+    statement: str
+    parameters: str
+    elapsed_ms: float
+    plan: List[str]
+
+
+class Instrumentation:
+    """Per-method call counts, latency histograms, rows returned and lock-wait time, plus a slow-query log.
+
+    Methods are wrapped with wrap(), statements are measured by the cursors returned by cursor_factory.
+    """
+
+    def __init__(self, slow_query_ms: float = 100, slow_query_log_size: int = 100):
+        # Statements slower than slow_query_ms go to the slow-query log (0 logs every statement)
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=slow_query_log_size)
+        self.methods: Dict[str, MethodStats] = {}
+        self.started = datetime.utcnow()
+        self.lock = Lock()
+        # Stack of the calls in progress on each thread, measurements go to the innermost one
+        self.local = local()
+
+    def stack(self) -> List[Call]:
+        try:
+            return self.local.calls
+        except AttributeError:
+            calls = self.local.calls = []
+            return calls
+
+    def current(self):
+        calls = self.stack()
+        return calls[-1] if calls else None
+
+    def record(self, call: Call):
+        with self.lock:
+            stats = self.methods.get(call.method)
+            if stats is None:
+                stats = self.methods[call.method] = MethodStats()
+            stats.add(call)
+
+    def wrap(self, name: str, method):
+        def instrumented(*args, **kwargs):
+            call = Call(name)
+            calls = self.stack()
+            calls.append(call)
+            started = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                call.failed = True
+                raise
+            finally:
+                call.elapsed = perf_counter() - started
+                calls.pop()
+                self.record(call)
+
+        def instrumented_generator(*args, **kwargs):
+            # Only the time spent producing rows is measured, not the time the caller spends between them
+            call = Call(name)
+            rows = method(*args, **kwargs)
+            calls = self.stack()
+            try:
+                while True:
+                    calls.append(call)
+                    started = perf_counter()
+                    try:
+                        row = next(rows)
+                    except StopIteration:
+                        return
+                    finally:
+                        call.elapsed += perf_counter() - started
+                        calls.pop()
+                    yield row
+            except Exception:
+                call.failed = True
+                raise
+            finally:
+                self.record(call)
+
+        wrapper = instrumented_generator if inspect.isgeneratorfunction(method) else instrumented
+        return functools.wraps(method)(wrapper)
+
+    def lock_waited(self, seconds: float):
+        call = self.current()
+        if call is not None:
+            call.lock_wait += seconds
+
+    def rows_returned(self, count: int):
+        call = self.current()
+        if call is not None:
+            call.rows += count
+
+    def statement(self, cursor: sqlite3.Cursor, statement: str, parameters, elapsed: float, plan: bool = True):
+        if elapsed * 1000 < self.slow_query_ms:
+            return
+
+        explained = []
+        if plan:
+            try:
+                explained = [row[3] for row in cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+            except sqlite3.Error:
+                # Statements such as BEGIN or PRAGMA have no query plan
+                pass
+
+        call = self.current()
+        self.slow_queries.append(
+            SlowQuery(
+                timestamp=datetime.utcnow().isoformat(timespec="seconds"),
+                method=call.method if call is not None else "",
+                statement=" ".join(statement.split()),
+                parameters=repr(parameters),
+                elapsed_ms=round(elapsed * 1000, 3),
+                plan=explained,
+            )
+        )
+
+    def cursor_factory(self, connection: sqlite3.Connection):
+        return InstrumentedCursor(connection, self)
+
+    def reset(self):
+        with self.lock:
+            self.methods.clear()
+            self.slow_queries.clear()
+            self.started = datetime.utcnow()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            methods = {name: stats.to_dict() for name, stats in sorted(self.methods.items())}
+            slow_queries = [query._asdict() for query in self.slow_queries]
+        return {"since": self.started.isoformat(timespec="seconds"), "methods": methods, "slow_queries": slow_queries}
+
+    def dump(self) -> str:
+        return json.dumps(self.snapshot(), indent=4, ensure_ascii=False)
+
+    def report(self) -> str:
+        # Plain text summary, slowest methods (by total time) first
+        snapshot = self.snapshot()
+        header = ("method", "calls", "errors", "total_ms", "avg_ms", "p95_ms", "max_ms", "rows", "lock_wait_ms")
+        lines = [header]
+        for name, stats in sorted(snapshot["methods"].items(), key=lambda item: item[1]["total_ms"], reverse=True):
+            lines.append((name, *(str(stats[column]) for column in header[1:])))
+        widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+        text = [f"Database statistics since {snapshot['since']} UTC", ""]
+        text += ["  ".join(value.ljust(width) for value, width in zip(line, widths)) for line in lines]
+        text += ["", f"Slow queries (>= {self.slow_query_ms} ms): {len(snapshot['slow_queries'])}"]
+        for query in snapshot["slow_queries"]:
+            text.append(f"[{query['timestamp']}] {query['method']} {query['elapsed_ms']} ms: {query['statement']}")
+            text.append(f"    parameters: {query['parameters']}")
+            text += [f"    plan: {step}" for step in query["plan"]]
+        return "\n".join(text)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor timing every statement and counting the rows it returns."""
+
+    def __init__(self, connection: sqlite3.Connection, instrumentation: Instrumentation):
+        super().__init__(connection)
+        self.instrumentation = instrumentation
+
+    def execute(self, statement, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(statement, parameters)
+        finally:
+            self.instrumentation.statement(self, statement, parameters, perf_counter() - started)
+
+    def executemany(self, statement, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(statement, seq_of_parameters)
+        finally:
+            # The parameters may be a consumed iterator, the row count stands in for them and the plan is skipped
+            self.instrumentation.statement(self, statement, f"{self.rowcount} rows", perf_counter() - started, plan=False)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.instrumentation.rows_returned(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.instrumentation.rows_returned(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.instrumentation.rows_returned(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self.instrumentation.rows_returned(1)
+        return row
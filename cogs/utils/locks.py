@@ -23,19 +23,45 @@ SOFTWARE.
 """
 
 import asyncio
+from typing import Dict, Hashable
+from weakref import WeakValueDictionary
 
 
 class Locks:
+    """One asyncio.Lock per key, e.g. (guild id, message id, user id).
+
+    The table only holds weak references: a lock disappears as soon as nobody holds or waits for it, so its size is bounded
+    by the events in flight rather than by every user who ever reacted. Everything runs on the event loop and get_lock
+    never awaits, so creating a lock needs no lock of its own.
+    """
+
     def __init__(self):
-        self.locks = {}
-        self.main_lock = asyncio.Lock()
+        self.locks: WeakValueDictionary = WeakValueDictionary()
+        self.created = 0
+        self.acquisitions = 0
+        # Acquisitions that found the lock held and had to wait
+        self.contended = 0
+        self.peak_size = 0
 
-    async def get_lock(self, user_id):
-        async with self.main_lock:
-            if not user_id in self.locks:
-                self.locks[user_id] = asyncio.Lock()
+    def get_lock(self, *key: Hashable) -> asyncio.Lock:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+            self.created += 1
+            self.peak_size = max(self.peak_size, len(self.locks))
+        self.acquisitions += 1
+        if lock.locked():
+            self.contended += 1
+        return lock
 
-            return self.locks[user_id]
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.locks),
+            "peak_size": self.peak_size,
+            "created": self.created,
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+        }
 
 
 lock_manager = Locks()
@@ -0,0 +1,152 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import disnake
+
+
+class Notification:
+    def __init__(self, user_id: int, guild_id: int, language: Optional[str]):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        # The guild's language as resolved with the reaction, None for the global language
+        self.language = language
+        # Role id -> (role name, True if added or False if removed)
+        self.changes: Dict[int, Tuple[str, bool]] = {}
+
+    def add(self, role: disnake.Role, added: bool):
+        previous = self.changes.get(role.id)
+        if previous is not None and previous[1] != added:
+            # Added and removed again (or the other way round) within the window, nothing changed for the user
+            del self.changes[role.id]
+        else:
+            self.changes[role.id] = (role.name, added)
+
+    @property
+    def added(self) -> List[str]:
+        return [name for name, added in self.changes.values() if added]
+
+    @property
+    def removed(self) -> List[str]:
+        return [name for name, added in self.changes.values() if not added]
+
+
+class NotificationDispatcher:
+    """Sends the role change DMs in the background, away from role assignment.
+
+    The changes of a user are collected for `window` seconds and sent as a single summary of the net change. Summaries wait
+    in a queue of at most `queue_size` entries (new ones are dropped while it is full) and are delivered by `workers` tasks
+    at no more than `rate` DMs per second, retrying failed deliveries up to `retries` times.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Notification], Awaitable[None]],
+        window: float = 2,
+        queue_size: int = 1000,
+        workers: int = 2,
+        rate: float = 5,
+        retries: int = 3,
+    ):
+        self.send = send
+        self.window = window
+        self.workers = workers
+        self.interval = 1 / rate if rate > 0 else 0
+        self.retries = retries
+        # (guild id, user id) -> changes waiting for the window to close
+        self.pending: Dict[Tuple[int, int], Notification] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.queue_size = queue_size
+        self.tasks: List[asyncio.Task] = []
+        self.next_send = 0.0
+        self.counters = {"requested": 0, "collapsed": 0, "queued": 0, "dropped": 0, "sent": 0, "retried": 0, "failed": 0}
+
+    def start(self):
+        # Started on first use, the workers need the running event loop
+        self.queue = asyncio.Queue(self.queue_size)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def notify(self, user_id: int, guild_id: int, role: disnake.Role, added: bool, language: Optional[str] = None):
+        if not self.tasks:
+            self.start()
+        self.counters["requested"] += 1
+        key = (guild_id, user_id)
+        notification = self.pending.get(key)
+        if notification is None:
+            notification = self.pending[key] = Notification(user_id, guild_id, language)
+            asyncio.get_running_loop().call_later(self.window, self.enqueue, key)
+        notification.add(role, added)
+
+    def enqueue(self, key: Tuple[int, int]):
+        notification = self.pending.pop(key)
+        if not notification.changes:
+            self.counters["collapsed"] += 1
+            return
+        try:
+            self.queue.put_nowait(notification)
+            self.counters["queued"] += 1
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            notification = await self.queue.get()
+            try:
+                for attempt in range(self.retries + 1):
+                    # Spaces the DMs of every worker out to the configured rate
+                    self.next_send = max(self.next_send + self.interval, loop.time())
+                    await asyncio.sleep(self.next_send - loop.time())
+                    try:
+                        await self.send(notification)
+                    except disnake.Forbidden:
+                        # The user does not accept DMs, retrying will not help
+                        self.counters["failed"] += 1
+                        break
+                    except (disnake.HTTPException, OSError, asyncio.TimeoutError) as error:
+                        if attempt == self.retries:
+                            print(f"Could not notify user {notification.user_id}: {error}")
+                            self.counters["failed"] += 1
+                        else:
+                            self.counters["retried"] += 1
+                            await asyncio.sleep(2**attempt)
+                    except Exception as error:
+                        # Keeps the worker alive whatever goes wrong with a single DM
+                        print(f"Could not notify user {notification.user_id}: {error!r}")
+                        self.counters["failed"] += 1
+                        break
+                    else:
+                        self.counters["sent"] += 1
+                        break
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self.pending), "depth": self.queue.qsize() if self.queue else 0, **self.counters}
@@ -42,6 +42,41 @@ class Config:
         self.system_channel = int(system_channel) if system_channel else None
         self.logo = str(self.config.get("server", "logo", fallback=None))
         self.language = str(self.config.get("server", "language", fallback="en-gb"))
+        # Role changes of a member within this window that undo each other are dropped without an API call
+        self.role_edit_window_ms = int(self.config.get("server", "role_edit_window_ms", fallback="250"))
+        # Reaction events are handled by a pool of workers fed by one bounded queue per guild
+        self.event_workers = int(self.config.get("server", "event_workers", fallback="8"))
+        self.event_guild_queue_size = int(self.config.get("server", "event_guild_queue_size", fallback="1000"))
+        self.event_guild_concurrency = int(self.config.get("server", "event_guild_concurrency", fallback="4"))
+        # Which event to drop once a guild's queue is full: the oldest waiting one or the new one
+        self.event_drop_policy = str(self.config.get("server", "event_drop_policy", fallback="oldest"))
+        # Role change DMs: collapsed per user over a window, then sent by background workers at a limited rate
+        self.notify_window_ms = int(self.config.get("server", "notify_window_ms", fallback="2000"))
+        self.notify_queue_size = int(self.config.get("server", "notify_queue_size", fallback="1000"))
+        self.notify_workers = int(self.config.get("server", "notify_workers", fallback="2"))
+        self.notify_rate = float(self.config.get("server", "notify_rate", fallback="5"))
+        self.notify_retries = int(self.config.get("server", "notify_retries", fallback="3"))
+        # SQLite connection tuning, see https://www.sqlite.org/pragma.html
+        self.db_journal_mode = str(self.config.get("database", "journal_mode", fallback="wal"))
+        self.db_synchronous = str(self.config.get("database", "synchronous", fallback="normal"))
+        self.db_cache_size = int(self.config.get("database", "cache_size", fallback="-16000"))
+        self.db_mmap_size = int(self.config.get("database", "mmap_size", fallback="268435456"))
+        self.db_busy_timeout = int(self.config.get("database", "busy_timeout", fallback="5000"))
+        self.db_guild_settings_cache_size = int(self.config.get("database", "guild_settings_cache_size", fallback="10000"))
+        self.db_admins_cache_size = int(self.config.get("database", "admins_cache_size", fallback="10000"))
+        self.db_selections_cache_size = int(self.config.get("database", "selections_cache_size", fallback="50000"))
+        # Group commit of batched writes, disabled with a window of 0
+        self.db_batch_window_ms = int(self.config.get("database", "batch_window_ms", fallback="0"))
+        self.db_batch_size = int(self.config.get("database", "batch_size", fallback="100"))
+        # Statements slower than slow_query_ms are kept in the slow-query log (0 logs every statement)
+        self.db_slow_query_ms = float(self.config.get("database", "slow_query_ms", fallback="100"))
+        self.db_slow_query_log_size = int(self.config.get("database", "slow_query_log_size", fallback="100"))
+        # Time the daily maintenance may spend returning free pages to the file system
+        self.db_maintenance_vacuum_ms = int(self.config.get("database", "maintenance_vacuum_ms", fallback="1000"))
+        # Hot backups written to files/backups, the newest backup_keep are retained
+        self.db_backup_keep = int(self.config.get("database", "backup_keep", fallback="7"))
+        self.db_backup_pages = int(self.config.get("database", "backup_pages", fallback="1024"))
+        self.db_backup_sleep_ms = int(self.config.get("database", "backup_sleep_ms", fallback="5"))
 
     def update(self, section, option, value):
         self.config[section][option] = value
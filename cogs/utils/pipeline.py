@@ -0,0 +1,137 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+from collections import deque
+import traceback
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+DROP_POLICIES = ("oldest", "newest")
+
+
+class EventPipeline:
+    """Runs event handlers on a fixed pool of workers fed by one bounded queue per guild.
+
+    Guilds with waiting events take turns (round robin), and at most `guild_concurrency` events of the same guild are handled
+    at once, so a burst in one guild cannot hold up the others. Once a guild has `guild_queue_size` events waiting, either its
+    oldest waiting event or the new one is dropped, depending on `drop_policy`.
+    """
+
+    def __init__(self, workers: int = 8, guild_queue_size: int = 1000, guild_concurrency: int = 4, drop_policy: str = "oldest"):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy: {drop_policy}")
+        self.workers = workers
+        self.guild_queue_size = guild_queue_size
+        self.guild_concurrency = guild_concurrency
+        self.drop_policy = drop_policy
+        # Guild id -> (time queued, handler, argument) of its waiting events
+        self.queues: Dict[int, Deque[Tuple[float, Callable[[Any], Awaitable[None]], Any]]] = {}
+        # Guilds with waiting events and a free slot, in the order they get served
+        self.ready: Optional[asyncio.Queue] = None
+        self.scheduled: Set[int] = set()
+        # Guild id -> events being handled
+        self.running: Dict[int, int] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.counters = {"submitted": 0, "handled": 0, "dropped": 0, "failed": 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        # Started on first use, the workers need the running event loop
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def submit(self, guild_id: int, handler: Callable[[Any], Awaitable[None]], argument: Any) -> bool:
+        # Queues handler(argument), returns False if the event was dropped
+        if not self.tasks:
+            self.start()
+        queue = self.queues.setdefault(guild_id, deque())
+        if len(queue) >= self.guild_queue_size:
+            self.counters["dropped"] += 1
+            if self.drop_policy == "newest":
+                return False
+            queue.popleft()
+        queue.append((asyncio.get_running_loop().time(), handler, argument))
+        self.counters["submitted"] += 1
+        self.schedule(guild_id)
+        return True
+
+    def schedule(self, guild_id: int):
+        # Puts the guild at the back of the line if it has waiting events and a free slot
+        if (
+            guild_id not in self.scheduled
+            and self.queues.get(guild_id)
+            and self.running.get(guild_id, 0) < self.guild_concurrency
+        ):
+            self.scheduled.add(guild_id)
+            self.ready.put_nowait(guild_id)
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            guild_id = await self.ready.get()
+            self.scheduled.discard(guild_id)
+            queue = self.queues.get(guild_id)
+            if not queue:
+                continue
+            queued_at, handler, argument = queue.popleft()
+            if not queue:
+                del self.queues[guild_id]
+            waited = loop.time() - queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+            self.running[guild_id] = self.running.get(guild_id, 0) + 1
+            # The guild's next event waits for its next turn
+            self.schedule(guild_id)
+            try:
+                await handler(argument)
+                self.counters["handled"] += 1
+            except Exception:
+                self.counters["failed"] += 1
+                traceback.print_exc()
+            finally:
+                self.running[guild_id] -= 1
+                if not self.running[guild_id]:
+                    del self.running[guild_id]
+                self.schedule(guild_id)
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.counters["handled"] + self.counters["failed"] + sum(self.running.values())
+        deepest = max(self.queues.items(), key=lambda item: len(item[1]), default=(None, ()))
+        return {
+            "depth": sum(len(queue) for queue in self.queues.values()),
+            "guilds_waiting": len(self.queues),
+            "deepest_guild": deepest[0],
+            "deepest_guild_depth": len(deepest[1]),
+            "running": sum(self.running.values()),
+            **self.counters,
+            "wait_avg_ms": round(self.wait_total / started * 1000, 2) if started else 0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
@@ -0,0 +1,123 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+from typing import Dict, List, Optional, Tuple
+import disnake
+
+
+def resolve(futures: List[asyncio.Future], result: bool = False, error: Optional[BaseException] = None):
+    # Skips the futures of requests that were cancelled in the meantime
+    for future in futures:
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+class PendingEdit:
+    def __init__(self, member: disnake.Member):
+        self.member = member
+        # Role id -> (role, True to add it or False to remove it, futures of the requests asking for it)
+        self.changes: Dict[int, Tuple[disnake.Role, bool, List[asyncio.Future]]] = {}
+
+
+class RoleEditCoalescer:
+    """Collects the role changes of each member over a short window, so the changes undone within it never reach the API.
+
+    add() and remove() return a future that resolves to True once the change was made, or to False when a later request
+    in the same window undid it (an add followed by a remove of the same role costs no API call at all).
+    The remaining changes still cost one API call per role, see apply().
+    The windows of a member are applied one after the other, the next one only starts once the previous calls finished.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        # (guild id, member id) -> changes waiting for the window to close
+        self.pending: Dict[Tuple[int, int], PendingEdit] = {}
+        # (guild id, member id) -> task applying the member's windows in turn
+        self.tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.requested = 0
+        self.api_calls = 0
+
+    def add(self, member: disnake.Member, role: disnake.Role) -> asyncio.Future:
+        return self.queue(member, role, True)
+
+    def remove(self, member: disnake.Member, role: disnake.Role) -> asyncio.Future:
+        return self.queue(member, role, False)
+
+    def queue(self, member: disnake.Member, role: disnake.Role, add: bool) -> asyncio.Future:
+        key = (member.guild.id, member.id)
+        edit = self.pending.get(key)
+        if edit is None:
+            edit = self.pending[key] = PendingEdit(member)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self.run(key))
+        # The newest member object has the most recent roles
+        edit.member = member
+        self.requested += 1
+
+        future = asyncio.get_running_loop().create_future()
+        previous = edit.changes.get(role.id)
+        if previous is None:
+            edit.changes[role.id] = (role, add, [future])
+        elif previous[1] == add:
+            previous[2].append(future)
+        else:
+            # The later request undoes the earlier one, neither needs an API call
+            del edit.changes[role.id]
+            resolve(previous[2] + [future], False)
+        return future
+
+    async def run(self, key: Tuple[int, int]):
+        # Changes queued while a window is being applied wait for the next window
+        try:
+            while key in self.pending:
+                await asyncio.sleep(self.window)
+                await self.apply(self.pending.pop(key))
+        finally:
+            del self.tasks[key]
+
+    async def apply(self, edit: PendingEdit):
+        # Only the atomic endpoints are used: they never touch the member's other roles, whatever the cache holds
+        # add_roles and remove_roles make one request per role with them, batching the roles saves no calls
+        to_add = [change for change in edit.changes.values() if change[1]]
+        to_remove = [change for change in edit.changes.values() if not change[1]]
+        for changes, method in ((to_add, edit.member.add_roles), (to_remove, edit.member.remove_roles)):
+            if not changes:
+                continue
+            self.api_calls += len(changes)
+            try:
+                await method(*(role for role, _, _ in changes))
+            except Exception as error:
+                for _, _, futures in changes:
+                    resolve(futures, error=error)
+            else:
+                for _, _, futures in changes:
+                    resolve(futures, True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self.pending), "requested": self.requested, "api_calls": self.api_calls}
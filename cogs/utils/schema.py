@@ -22,17 +22,42 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
+from functools import partial
 import sqlite3
+import time
 import disnake
 
+from cogs.utils.database import SCHEMA_VERSION
 from cogs.utils.sanitizing import sanitize_emoji
 
+# Maximum number of channels fetched from Discord at the same time while migrating from version 0
+CHANNEL_FETCH_CONCURRENCY = 10
+# Steps (keyed by the version they upgrade from) that read the Discord cache, so they can only run once the bot is connected
+CLIENT_STEPS = (0, 1)
+# Steps that run statements which are not allowed inside a transaction, such as VACUUM
+NON_TRANSACTIONAL_STEPS = (9,)
+
 
 class SchemaHandler:
     def __init__(self, database, client):
         self.database = database
         self.client = client
         self.version = self.version_check()
+        # Every step upgrades the schema from the version it is keyed by to the next one
+        self.steps = {
+            0: self.zero_to_one,
+            1: self.one_to_two,
+            2: self.two_to_three,
+            3: self.three_to_four,
+            4: self.four_to_five,
+            5: self.five_to_six,
+            6: self.six_to_seven,
+            7: self.seven_to_eight,
+            8: self.eight_to_nine,
+            9: self.nine_to_ten,
+            10: self.ten_to_eleven,
+        }
 
     def version_check(self):
         conn = sqlite3.connect(self.database)
@@ -63,88 +88,154 @@ class SchemaHandler:
         conn.close()
         self.version = version
 
-    def zero_to_one(self):
+    @property
+    def current(self):
+        return self.version >= SCHEMA_VERSION
+
+    def migrate_offline(self):
+        """Apply the pending steps that can run before the bot connects, returns whether the schema is now current"""
+        if self.version in CLIENT_STEPS:
+            return False
+
+        started = time.perf_counter()
+        initial_version = self.version
+        while not self.current:
+            self.apply(self.steps[self.version])
+
+        if self.version != initial_version:
+            print(
+                f"Migrated the database from version {initial_version} to {self.version}"
+                f" in {time.perf_counter() - started:.2f}s"
+            )
+        return True
+
+    async def migrate(self):
+        """Apply every pending step, each one atomically together with its version bump"""
+        if self.current:
+            return
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        initial_version = self.version
+        while not self.current:
+            args = ()
+            if self.version == 0:
+                # Resolving guilds needs the Discord API, so it happens before the step's transaction is opened
+                args = (await self.resolve_channel_guilds(),)
+            await loop.run_in_executor(None, partial(self.apply, self.steps[self.version], *args))
+
+        print(f"Migrated the database from version {initial_version} to {self.version} in {time.perf_counter() - started:.2f}s")
+
+    def apply(self, step, *args):
+        """Run a single step and the version bump in one transaction, rolling both back on failure"""
+        target = self.version + 1
+        print(f"Migrating the database to version {target}...")
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.database, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            if self.version in NON_TRANSACTIONAL_STEPS:
+                # The step is atomic on its own and safe to repeat if the version bump below is lost
+                step(cursor, *args)
+                cursor.execute("BEGIN IMMEDIATE;")
+            else:
+                cursor.execute("BEGIN IMMEDIATE;")
+                step(cursor, *args)
+            cursor.execute("UPDATE dbinfo SET version = ? WHERE version = ?;", (target, self.version))
+            cursor.execute("COMMIT;")
+        except BaseException:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK;")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        self.version = target
+        print(f"Migrated the database to version {target} in {time.perf_counter() - started:.2f}s")
+
+    async def resolve_channel_guilds(self):
+        """Fetch the guild of every channel with reaction-role messages, a few channels at a time"""
         conn = sqlite3.connect(self.database)
         cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT channel FROM messages WHERE channel IS NOT NULL;")
+        channel_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        if not channel_ids:
+            return []
+
+        semaphore = asyncio.Semaphore(CHANNEL_FETCH_CONCURRENCY)
+        resolved = 0
+
+        async def resolve(channel_id):
+            nonlocal resolved
+            async with semaphore:
+                try:
+                    channel = await self.client.getchannel(channel_id)
+                except disnake.HTTPException:
+                    channel = None
+
+            resolved += 1
+            if resolved % 100 == 0 or resolved == len(channel_ids):
+                print(f"Resolved {resolved}/{len(channel_ids)} channels")
+            if channel is None:
+                return None
+
+            return channel.guild.id, channel_id
+
+        results = await asyncio.gather(*(resolve(channel_id) for channel_id in channel_ids))
+        return [result for result in results if result is not None]
+
+    def zero_to_one(self, cursor, channel_guilds=()):
         cursor.execute("PRAGMA table_info(messages);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
         if "guild_id" not in columns:
             cursor.execute("ALTER TABLE messages ADD COLUMN 'guild_id' INT;")
-            conn.commit()
 
-        cursor.close()
-        conn.close()
-        self.set_version(1)
+        # channel_guilds holds (guild_id, channel_id) pairs
+        cursor.executemany("UPDATE messages SET guild_id = ? WHERE channel = ?;", channel_guilds)
 
-    def one_to_two(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
+    def one_to_two(self, cursor):
         cursor.execute("PRAGMA table_info(admins);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
         if "guild_id" not in columns:
             cursor.execute("SELECT role_id FROM admins")
-            admins = cursor.fetchall()
-            admins2 = []
-            for admin in admins:
-                admins2.append(admin[0])
-            admins = admins2
-            guilds = {}
+            admins = [admin[0] for admin in cursor.fetchall()]
+            guild_admins = []
             for guild in self.client.guilds:
-                guilds[guild.id] = []
                 for admin_id in admins:
-                    role = disnake.utils.get(guild.roles, id=admin_id)
+                    role = guild.get_role(admin_id)
                     if role is not None:
-                        guilds[guild.id].append(role.id)
+                        guild_admins.append((guild.id, role.id))
 
             cursor.execute("ALTER TABLE admins ADD COLUMN 'guild_id' INT;")
-            conn.commit()
-            for guild in guilds:
-                for admin_id in guilds[guild]:
-                    cursor.execute("UPDATE admins SET guild_id = ? WHERE role_id = ?;", (guild, admin_id))
+            cursor.executemany("UPDATE admins SET guild_id = ? WHERE role_id = ?;", guild_admins)
             cursor.execute("DELETE FROM admins WHERE guild_id IS NULL;")
-            conn.commit()
 
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='systemchannels';")
         systemchannels_table = cursor.fetchall()
         if systemchannels_table:
             cursor.execute("SELECT * FROM systemchannels;")
-            entries = cursor.fetchall()
-            for entry in entries:
-                guild_id = entry[0]
-                channel_id = entry[1]
-                notify = 0  # Set default to not notify
-                cursor.execute(
-                    "INSERT INTO guild_settings ('guild_id', 'notify', 'systemchannel') values(?, ?, ?);",
-                    (guild_id, notify, channel_id),
-                )
+            # Set default to not notify
+            entries = [(entry[0], 0, entry[1]) for entry in cursor.fetchall()]
+            cursor.executemany(
+                "INSERT INTO guild_settings ('guild_id', 'notify', 'systemchannel') values(?, ?, ?);",
+                entries,
+            )
             cursor.execute("DROP TABLE systemchannels;")
-            conn.commit()
-
-        cursor.close()
-        conn.close()
-        self.set_version(2)
 
-    def two_to_three(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
+    def two_to_three(self, cursor):
         cursor.execute("PRAGMA table_info(messages);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
         if "limit_to_one" not in columns:
             cursor.execute("ALTER TABLE messages ADD COLUMN 'limit_to_one' INT;")
             cursor.execute("UPDATE messages SET limit_to_one = 0 WHERE limit_to_one IS NULL;")
-            conn.commit()
-
-        cursor.close()
-        conn.close()
-        self.set_version(3)
-
-    def three_to_four(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
 
+    def three_to_four(self, cursor):
         cursor.execute("PRAGMA table_info(reactionroles);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
@@ -166,63 +257,130 @@ class SchemaHandler:
                 # reactionrole_id, reaction, role_id -> reaction, reactionrole_id, role_id
                 targets = [(i[1], i[0], i[2]) for i in targets]
                 cursor.executemany("UPDATE reactionroles SET reaction = ? WHERE reactionrole_id = ? AND role_id = ?;", targets)
-                conn.commit()
-
-        cursor.close()
-        conn.close()
 
-        self.set_version(4)
-
-    def four_to_five(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
+    def four_to_five(self, cursor):
         cursor.execute("PRAGMA table_info(reactionroles);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
         if "message_id" not in columns:
-            cursor.execute("ALTER TABLE reactionroles ADD COLUMN 'message_id' INT;")
-            cursor.execute("SELECT reactionrole_id, message_id FROM messages;")
-            result = cursor.fetchall()
-            for reaction_role in result:
-                reactionrole_id: int = reaction_role[0]
-                message_id: int = reaction_role[1]
-                cursor.execute(
-                    "UPDATE reactionroles SET message_id = ? WHERE reactionrole_id = ?;", (message_id, reactionrole_id)
-                )
-
-            cursor.execute("SELECT message_id, reaction, role_id FROM reactionroles;")
-            reactionroles = cursor.fetchall()
-            cursor.execute("SELECT message_id, channel, guild_id, limit_to_one FROM messages;")
-            messages = cursor.fetchall()
-            cursor.execute("DROP TABLE reactionroles;")
-            cursor.execute("DROP TABLE messages;")
+            # Copies message_id over from messages and drops the reactionrole_id columns, all inside SQLite
+            cursor.execute("ALTER TABLE reactionroles RENAME TO reactionroles_old;")
+            cursor.execute("ALTER TABLE messages RENAME TO messages_old;")
             cursor.execute("CREATE TABLE 'reactionroles' ('message_id' INT, 'reaction' NVCARCHAR, 'role_id' INT);")
             cursor.execute("CREATE TABLE 'messages' ('message_id' INT, 'channel' INT, 'guild_id' INT, 'limit_to_one' INT);")
-            cursor.executemany(
-                "INSERT INTO 'reactionroles' ('message_id', 'reaction', 'role_id') values(?, ?, ?);", reactionroles
+            cursor.execute(
+                "INSERT INTO reactionroles (message_id, reaction, role_id)"
+                " SELECT messages_old.message_id, reactionroles_old.reaction, reactionroles_old.role_id"
+                " FROM reactionroles_old LEFT JOIN messages_old"
+                " ON messages_old.reactionrole_id = reactionroles_old.reactionrole_id;"
             )
-            cursor.executemany(
-                "INSERT INTO 'messages' ('message_id', 'channel', 'guild_id', 'limit_to_one') values(?, ?, ?, ?);", messages
+            cursor.execute(
+                "INSERT INTO messages (message_id, channel, guild_id, limit_to_one)"
+                " SELECT message_id, channel, guild_id, limit_to_one FROM messages_old;"
             )
-            conn.commit()
-
-        cursor.close()
-        conn.close()
-
-        self.set_version(5)
+            cursor.execute("DROP TABLE reactionroles_old;")
+            cursor.execute("DROP TABLE messages_old;")
 
-    def five_to_six(self):
+    def five_to_six(self, cursor):
         """Add language to guild_settings if it does not exist"""
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
         cursor.execute("PRAGMA table_info(guild_settings);")
         result = cursor.fetchall()
         columns = [value[1] for value in result]
         if "language" not in columns:
             cursor.execute("ALTER TABLE guild_settings ADD COLUMN 'language' TEXT NULL;")
-            conn.commit()
 
-        cursor.close()
-        conn.close()
+    def six_to_seven(self, cursor):
+        """Index every column the bot looks rows up by"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS reactionroles_message_reaction_idx ON reactionroles (message_id, reaction);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_channel_idx ON messages (channel);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages (guild_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS admins_guild_role_idx ON admins (guild_id, role_id);")
+
+    def seven_to_eight(self, cursor):
+        """Rebuild the tables with typed columns, primary keys and a cascading foreign key from messages to reactionroles"""
+        cursor.execute("PRAGMA foreign_key_list(reactionroles);")
+        rebuilt = cursor.fetchall()
+        if not rebuilt:
+            for table in ("messages", "reactionroles", "admins", "guild_settings", "cleanup_queue_guilds"):
+                cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_old;")
+
+            cursor.execute(
+                "CREATE TABLE 'messages' ('message_id' INTEGER PRIMARY KEY, 'channel' INTEGER NOT NULL,"
+                " 'guild_id' INTEGER, 'limit_to_one' INTEGER NOT NULL DEFAULT 0);"
+            )
+            cursor.execute(
+                "CREATE TABLE 'reactionroles' ('message_id' INTEGER NOT NULL"
+                " REFERENCES messages (message_id) ON DELETE CASCADE, 'reaction' TEXT NOT NULL, 'role_id' INTEGER NOT NULL,"
+                " PRIMARY KEY (message_id, reaction)) WITHOUT ROWID;"
+            )
+            cursor.execute(
+                "CREATE TABLE 'admins' ('role_id' INTEGER NOT NULL, 'guild_id' INTEGER NOT NULL,"
+                " PRIMARY KEY (guild_id, role_id)) WITHOUT ROWID;"
+            )
+            cursor.execute(
+                "CREATE TABLE 'guild_settings' ('guild_id' INTEGER PRIMARY KEY, 'notify' INTEGER NOT NULL DEFAULT 0,"
+                " 'systemchannel' INTEGER NOT NULL DEFAULT 0, 'language' TEXT NULL);"
+            )
+            cursor.execute(
+                "CREATE TABLE 'cleanup_queue_guilds' ('guild_id' INTEGER PRIMARY KEY, 'unix_timestamp' INTEGER NOT NULL);"
+            )
+
+            # Duplicates, incomplete rows and reactionroles of deleted messages are dropped while copying
+            cursor.execute(
+                "INSERT OR IGNORE INTO messages (message_id, channel, guild_id, limit_to_one)"
+                " SELECT message_id, channel, guild_id, COALESCE(limit_to_one, 0) FROM messages_old"
+                " WHERE message_id IS NOT NULL AND channel IS NOT NULL;"
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO reactionroles (message_id, reaction, role_id)"
+                " SELECT message_id, reaction, role_id FROM reactionroles_old"
+                " WHERE message_id IN (SELECT message_id FROM messages) AND reaction IS NOT NULL AND role_id IS NOT NULL;"
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO admins (role_id, guild_id) SELECT role_id, guild_id FROM admins_old"
+                " WHERE role_id IS NOT NULL AND guild_id IS NOT NULL;"
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO guild_settings (guild_id, notify, systemchannel, language)"
+                " SELECT guild_id, COALESCE(notify, 0), COALESCE(systemchannel, 0), language FROM guild_settings_old"
+                " WHERE guild_id IS NOT NULL;"
+            )
+            cursor.execute(
+                "INSERT INTO cleanup_queue_guilds (guild_id, unix_timestamp)"
+                " SELECT guild_id, MIN(unix_timestamp) FROM cleanup_queue_guilds_old"
+                " WHERE guild_id IS NOT NULL AND unix_timestamp IS NOT NULL GROUP BY guild_id;"
+            )
 
-        self.set_version(6)
+            for table in ("messages", "reactionroles", "admins", "guild_settings", "cleanup_queue_guilds"):
+                cursor.execute(f"DROP TABLE {table}_old;")
+
+        # The primary keys replace the v7 indexes on reactionroles and admins
+        cursor.execute("DROP INDEX IF EXISTS reactionroles_message_reaction_idx;")
+        cursor.execute("DROP INDEX IF EXISTS admins_guild_role_idx;")
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_channel_idx ON messages (channel);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages (guild_id);")
+
+    def eight_to_nine(self, cursor):
+        """Index the cleanup queue by the time guilds were queued"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS cleanup_queue_guilds_timestamp_idx ON cleanup_queue_guilds (unix_timestamp);")
+
+    def nine_to_ten(self, cursor):
+        """Switch to incremental auto-vacuum so the maintenance task can hand free pages back to the file system"""
+        cursor.execute("PRAGMA auto_vacuum;")
+        if cursor.fetchone()[0] != 2:
+            # Changing auto_vacuum on an existing database only takes effect after rebuilding it
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            cursor.execute("VACUUM;")
+
+    def ten_to_eleven(self, cursor):
+        """Record the reaction each user picked on limit_to_one messages"""
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS 'selections' ('message_id' INTEGER NOT NULL"
+            " REFERENCES messages (message_id) ON DELETE CASCADE, 'user_id' INTEGER NOT NULL, 'reaction' TEXT NOT NULL,"
+            " PRIMARY KEY (message_id, user_id)) WITHOUT ROWID;"
+        )
+        # Messages created before this version are backfilled from their reactions on first use
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS 'selection_backfills' ('message_id' INTEGER PRIMARY KEY"
+            " REFERENCES messages (message_id) ON DELETE CASCADE);"
+        )
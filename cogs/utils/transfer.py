@@ -0,0 +1,236 @@
+"""
+MIT License
+
+Copyright (c) 2019-present eibex
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from cogs.utils.database import SCHEMA_VERSION, connect, initialize
+
+# Exported tables and their columns, in an order that satisfies the foreign key from reactionroles to messages
+TABLES = {
+    "messages": ("message_id", "channel", "guild_id", "limit_to_one"),
+    "reactionroles": ("message_id", "reaction", "role_id"),
+    "admins": ("role_id", "guild_id"),
+    "guild_settings": ("guild_id", "notify", "systemchannel", "language"),
+}
+PRIMARY_KEYS = {
+    "messages": ("message_id",),
+    "reactionroles": ("message_id", "reaction"),
+    "admins": ("guild_id", "role_id"),
+    "guild_settings": ("guild_id",),
+}
+# Columns stored as text, every other column is an integer
+TEXT_COLUMNS = ("reaction", "language")
+FORMATS = ("ndjson", "csv")
+# Rows handed to a single executemany call when importing
+BATCH_SIZE = 50000
+
+Progress = Optional[Callable[[str, int], None]]
+
+
+class TransferError(Exception):
+    pass
+
+
+def export_data(database: str, destination: str, fmt: str = "ndjson", progress: Progress = None) -> Dict[str, int]:
+    """Stream every table to destination and return the number of rows written per table.
+
+    ndjson writes a single file with a "table" key on every line, csv writes one <table>.csv file per table into the
+    destination directory. The export reads a single snapshot, so it can run while the bot is online.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Invalid format: {fmt}")
+
+    conn = sqlite3.connect(database, isolation_level=None)
+    # A single encoder, json.dumps builds a new one on every call when given options
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    counts = {}
+    try:
+        conn.execute("BEGIN;")
+        if fmt == "ndjson":
+            with open(destination, "w", encoding="utf-8") as file:
+                for table, columns in TABLES.items():
+                    counts[table] = 0
+                    for row in _read_table(conn, table, columns):
+                        file.write(f"{encode({'table': table, **dict(zip(columns, row))})}\n")
+                        counts[table] = _count(counts[table], table, progress)
+        else:
+            os.makedirs(destination, exist_ok=True)
+            for table, columns in TABLES.items():
+                counts[table] = 0
+                with open(os.path.join(destination, f"{table}.csv"), "w", encoding="utf-8", newline="") as file:
+                    writer = csv.writer(file)
+                    writer.writerow(columns)
+                    for row in _read_table(conn, table, columns):
+                        # NULL is written as an empty field
+                        writer.writerow(["" if value is None else value for value in row])
+                        counts[table] = _count(counts[table], table, progress)
+        conn.execute("COMMIT;")
+    finally:
+        conn.close()
+
+    return counts
+
+
+def import_data(
+    database: str, source: str, fmt: str = "ndjson", batch_size: int = BATCH_SIZE, progress: Progress = None
+) -> Dict[str, int]:
+    """Insert (or update) the rows exported by export_data in one transaction and return the number of rows per table.
+
+    Meant to run while the bot is stopped, a running bot would need Database.load_caches() to see the new rows.
+    Nothing is imported if any row is invalid.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Invalid format: {fmt}")
+
+    conn = connect(database)
+    counts = {table: 0 for table in TABLES}
+    batches = {table: [] for table in TABLES}
+    statements = {table: _upsert(table) for table in TABLES}
+    try:
+        # Creates the tables of a new database, without loading the existing rows the way Database would
+        conn.execute("BEGIN IMMEDIATE;")
+        initialize(conn.cursor())
+        conn.execute("COMMIT;")
+        version = conn.execute("SELECT version FROM dbinfo;").fetchone()
+        if version is None or version[0] != SCHEMA_VERSION:
+            raise TransferError(f"The database must be migrated to version {SCHEMA_VERSION} before importing")
+
+        conn.execute("BEGIN IMMEDIATE;")
+        # Rows may reference messages further down the file, foreign keys are checked on commit instead
+        conn.execute("PRAGMA defer_foreign_keys = ON;")
+        for table, row in _read_source(source, fmt):
+            batch = batches[table]
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(statements[table], batch)
+                counts[table] += len(batch)
+                batch.clear()
+                if progress is not None:
+                    progress(table, counts[table])
+
+        for table, batch in batches.items():
+            if batch:
+                conn.executemany(statements[table], batch)
+                counts[table] += len(batch)
+                if progress is not None:
+                    progress(table, counts[table])
+        conn.execute("COMMIT;")
+    except sqlite3.IntegrityError as error:
+        raise TransferError(f"Invalid rows, nothing was imported: {error}") from error
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        conn.close()
+
+    return counts
+
+
+def _read_table(conn: sqlite3.Connection, table: str, columns: Tuple[str, ...]) -> Iterator[tuple]:
+    # Iterating the cursor streams the rows instead of loading the whole table
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {', '.join(PRIMARY_KEYS[table])};")
+    cursor.arraysize = 1000
+    yield from cursor
+
+
+def _count(count: int, table: str, progress: Progress) -> int:
+    count += 1
+    if progress is not None and count % BATCH_SIZE == 0:
+        progress(table, count)
+    return count
+
+
+def _upsert(table: str) -> str:
+    columns = TABLES[table]
+    keys = PRIMARY_KEYS[table]
+    values = [column for column in columns if column not in keys]
+    statement = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) ON CONFLICT ({', '.join(keys)})"
+    )
+    if not values:
+        return f"{statement} DO NOTHING;"
+    return f"{statement} DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in values)};"
+
+
+def _integer(value: str):
+    # CSV fields are always strings and NULL is an empty field
+    return int(value) if value else None
+
+
+def _text(value: str):
+    return value if value else None
+
+
+def _read_source(source: str, fmt: str) -> Iterator[Tuple[str, tuple]]:
+    if fmt == "ndjson":
+        with open(source, encoding="utf-8") as file:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                table = entry.get("table")
+                if table not in TABLES:
+                    raise TransferError(f"Line {line_number}: unknown table {table!r}")
+                # JSON keeps the column types, missing columns are NULL
+                yield table, tuple(map(entry.get, TABLES[table]))
+    else:
+        for table, columns in TABLES.items():
+            path = os.path.join(source, f"{table}.csv")
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8", newline="") as file:
+                reader = csv.reader(file)
+                header = next(reader, [])
+                missing = set(columns) - set(header)
+                if missing:
+                    raise TransferError(f"{path}: missing columns {', '.join(sorted(missing))}")
+                fields = [(header.index(column), _text if column in TEXT_COLUMNS else _integer) for column in columns]
+                for entry in reader:
+                    yield table, tuple(convert(entry[index]) for index, convert in fields)
+
+
+if __name__ == "__main__":
+    directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    parser = argparse.ArgumentParser(description="Export or import the Reaction Light reaction-role data.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="ndjson file, or directory of <table>.csv files")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--database", default=f"{directory}/files/reactionlight.db")
+    args = parser.parse_args()
+
+    def report(table, count):
+        print(f"{table}: {count} rows")
+
+    started = time.perf_counter()
+    if args.action == "export":
+        counts = export_data(args.database, args.path, args.format, progress=report)
+    else:
+        counts = import_data(args.database, args.path, args.format, progress=report)
+    total = sum(counts.values())
+    print(f"{args.action.capitalize()}ed {total} rows ({counts}) in {time.perf_counter() - started:.2f}s")
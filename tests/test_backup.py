@@ -0,0 +1,63 @@
+import sqlite3
+import pytest
+
+from cogs.utils.backup import BackupError, BackupManager, restore, verify
+from cogs.utils.database import Database
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = Database(str(tmp_path / "reactionlight.db"), batch_window=60)
+    for guild_id in range(1, 101):
+        db.add_cleanup_guild(guild_id, 0)
+    db.flush()
+    yield db
+    db.close()
+
+
+def cleanup_guilds(path):
+    conn = sqlite3.connect(path)
+    count = conn.execute("SELECT COUNT(*) FROM cleanup_queue_guilds;").fetchone()[0]
+    conn.close()
+    return count
+
+
+class TestBackup:
+    @pytest.mark.parametrize("method", ["online", "vacuum"])
+    def test_create(self, database, tmp_path, method):
+        manager = BackupManager(database.database, str(tmp_path / "backups"), pages=1, sleep=0)
+        # Writes that are still pending in a batch are not part of the backup
+        database.add_cleanup_guild(101, 0)
+        path = manager.create(method)
+        verify(path)
+        assert cleanup_guilds(path) == 100
+        assert manager.backups() == [path]
+
+    def test_create_outside_wal_mode(self, tmp_path):
+        db = Database(str(tmp_path / "reactionlight.db"), journal_mode="delete")
+        db.add_cleanup_guild(1, 0)
+        manager = BackupManager(db.database, str(tmp_path / "backups"), pages=1, sleep=0)
+        path = manager.create("online")
+        # The bot can still write once the backup is done
+        db.add_cleanup_guild(2, 0)
+        db.close()
+        verify(path)
+        assert cleanup_guilds(path) == 1
+
+    def test_rotate(self, database, tmp_path):
+        manager = BackupManager(database.database, str(tmp_path / "backups"), keep=2)
+        paths = [manager.create() for _ in range(3)]
+        assert manager.backups() == paths[1:]
+
+    def test_restore(self, database, tmp_path):
+        manager = BackupManager(database.database, str(tmp_path / "backups"))
+        path = manager.create()
+        target = str(tmp_path / "restored.db")
+        restore(path, target)
+        assert cleanup_guilds(target) == 100
+
+    def test_verify_rejects_corrupt_files(self, tmp_path):
+        path = tmp_path / "corrupt.db"
+        path.write_bytes(b"not a database" * 100)
+        with pytest.raises(BackupError):
+            verify(str(path))
@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+import disnake
+
+from cogs.cleaner import Cleaner
+
+
+def http_error(error, status):
+    return error(SimpleNamespace(status=status, reason=""), "")
+
+
+class FakeDatabase:
+    def __init__(self, due_guilds):
+        self.due_guilds = due_guilds
+        self.removed_cleanup = []
+        self.removed_guilds = []
+
+    async def fetch_due_cleanup_guilds(self, timestamp):
+        return [(guild_id, 0) for guild_id in self.due_guilds]
+
+    async def remove_cleanup_guild(self, guild_id):
+        self.removed_cleanup.append(guild_id)
+
+    async def remove_guilds(self, guild_ids):
+        self.removed_guilds.extend(guild_ids)
+
+
+class FakeBot:
+    def __init__(self, due_guilds, errors):
+        self.db = FakeDatabase(due_guilds)
+        self.errors = errors
+
+    async def fetch_guild(self, guild_id):
+        if guild_id in self.errors:
+            raise self.errors[guild_id]
+        return SimpleNamespace(id=guild_id)
+
+
+def purge(due_guilds, errors):
+    bot = FakeBot(due_guilds, errors)
+    # The loops are not started, only the purge itself is exercised
+    cleaner = Cleaner.__new__(Cleaner, bot)
+    cleaner.bot = bot
+    return asyncio.run(cleaner.purge_expired_guilds()), bot.db
+
+
+class TestPurgeExpiredGuilds:
+    def test_not_found_and_forbidden_are_purged(self):
+        errors = {1: http_error(disnake.NotFound, 404), 2: http_error(disnake.Forbidden, 403)}
+        done, db = purge([1, 2], errors)
+        assert done
+        assert db.removed_guilds == [1, 2]
+        assert db.removed_cleanup == []
+
+    def test_reachable_guild_is_dequeued(self):
+        done, db = purge([1, 2], {2: http_error(disnake.Forbidden, 403)})
+        assert done
+        assert db.removed_cleanup == [1]
+        assert db.removed_guilds == [2]
+
+    def test_transient_error_does_not_stall_queue(self):
+        errors = {1: http_error(disnake.DiscordServerError, 503), 2: http_error(disnake.NotFound, 404)}
+        done, db = purge([1, 2, 3], errors)
+        # The unreachable guild is retried later, the ones behind it are still handled
+        assert not done
+        assert db.removed_guilds == [2]
+        assert db.removed_cleanup == [3]
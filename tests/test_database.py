@@ -0,0 +1,660 @@
+from typing import Dict, List
+import asyncio
+import inspect
+import sqlite3
+import threading
+import pytest
+
+from cogs.utils.database import SCHEMA_VERSION, AsyncDatabase, Database
+from cogs.utils.schema import SchemaHandler
+
+# Methods that read whole tables on purpose
+FULL_TABLE_SCANS = {
+    "load_caches",
+    "load_reactionroles",
+    "load_guild_settings",
+    "load_cleanup_guilds",
+    "sweep_orphans",
+    "optimize",
+}
+
+# Scratch tables the bot fills with the keys of a bulk operation, reading them whole is expected
+TEMPORARY_TABLES = {"purge_guilds", "present_guilds"}
+
+# Methods that never reach SQLite
+NO_QUERIES = {
+    "cursor",
+    "transaction",
+    "flush",
+    "close",
+    "exists",
+    "get_reactions",
+    "isunique",
+    "selections_tracked",
+    "cached_resolve_reaction",
+    "cached_selection",
+    "cached_guild_settings",
+    "cached_admins",
+    "cleanup_queued",
+}
+
+MESSAGE_ID = 1000
+CHANNEL_ID = 2000
+GUILD_ID = 3000
+ROLE_ID = 4000
+USER_ID = 5000
+
+CALLS = [
+    (
+        "add_reaction_role",
+        (
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 1,
+                "reactions": {"🔥": ROLE_ID},
+            },
+        ),
+    ),
+    ("load_reactionroles", ()),
+    ("resolve_reaction", (MESSAGE_ID, "🔥", GUILD_ID)),
+    ("fetch_messages", (CHANNEL_ID,)),
+    ("fetch_all_messages", ()),
+    ("iter_all_messages", (1,)),
+    ("add_guild", (CHANNEL_ID, GUILD_ID)),
+    ("add_reaction", (MESSAGE_ID, ROLE_ID + 1, "💧")),
+    ("remove_reaction", (MESSAGE_ID, "💧")),
+    ("add_admin", (ROLE_ID, GUILD_ID)),
+    ("get_admins", (GUILD_ID,)),
+    ("remove_admin", (ROLE_ID, GUILD_ID)),
+    ("load_caches", ()),
+    ("load_guild_settings", ()),
+    ("load_cleanup_guilds", ()),
+    ("get_guild_settings", (GUILD_ID + 1,)),
+    ("add_systemchannel", (GUILD_ID, CHANNEL_ID)),
+    ("fetch_systemchannel", (GUILD_ID,)),
+    ("remove_systemchannel", (GUILD_ID,)),
+    ("toggle_notify", (GUILD_ID,)),
+    ("notify", (GUILD_ID,)),
+    ("set_language", (GUILD_ID, "en-gb")),
+    ("get_language", (GUILD_ID + 2,)),
+    ("fetch_all_guilds", ()),
+    ("iter_all_guilds", (1,)),
+    ("add_cleanup_guild", (GUILD_ID, 0)),
+    ("fetch_cleanup_guilds", ()),
+    ("fetch_due_cleanup_guilds", (1,)),
+    ("next_cleanup_timestamp", ()),
+    ("iter_cleanup_guilds", (1,)),
+    ("backfill_selections", (MESSAGE_ID, {USER_ID: "🔥"})),
+    ("get_selection", (MESSAGE_ID, USER_ID + 1)),
+    ("set_selection", (MESSAGE_ID, USER_ID, "🔥")),
+    ("clear_selection", (MESSAGE_ID, USER_ID, "🔥")),
+    ("sweep_orphans", ([GUILD_ID],)),
+    ("optimize", ()),
+    ("free_pages", ()),
+    ("incremental_vacuum", ()),
+    ("remove_cleanup_guild", (GUILD_ID,)),
+    ("delete", (MESSAGE_ID,)),
+    ("remove_guild", (GUILD_ID,)),
+    ("remove_guilds", ([GUILD_ID + 1, GUILD_ID + 2],)),
+]
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = Database(str(tmp_path / "reactionlight.db"), guild_settings_cache_size=1)
+    # Two guilds overflow the single cache slot, so guild settings lookups miss and reach SQLite
+    db.set_language(GUILD_ID + 1, "en-gb")
+    db.set_language(GUILD_ID + 2, "en-gb")
+    yield db
+    db.close()
+
+
+def record_statements(database: Database) -> Dict[str, List[str]]:
+    # Runs every call in CALLS and returns the SQL statements each method executed
+    statements: Dict[str, List[str]] = {}
+    for method, args in CALLS:
+        executed = statements.setdefault(method, [])
+        database.conn.set_trace_callback(executed.append)
+        result = getattr(database, method)(*args)
+        if inspect.isgenerator(result):
+            list(result)
+    database.conn.set_trace_callback(None)
+    return statements
+
+
+def full_scans(database: Database, statement: str) -> List[str]:
+    cursor = database.conn.cursor()
+    cursor.execute(f"EXPLAIN QUERY PLAN {statement}")
+    plan = [row[3] for row in cursor.fetchall()]
+    cursor.close()
+    return [step for step in plan if step.startswith("SCAN ") and step.split()[1] not in TEMPORARY_TABLES]
+
+
+class TestQueryPlans:
+    def test_every_method_is_checked(self):
+        public_methods = {name for name in dir(Database) if not name.startswith("_") and callable(getattr(Database, name))}
+        assert public_methods - NO_QUERIES == {method for method, _ in CALLS}
+
+    def test_no_full_scans(self, database):
+        recorded = record_statements(database)
+        # optimize analysed the nearly empty tables and scans look cheap on them, plan for tables of a real bot instead
+        with database.cursor() as cursor:
+            cursor.execute("UPDATE sqlite_stat1 SET stat = '100000' || substr(stat, instr(stat || ' ', ' '));")
+            cursor.execute("ANALYZE sqlite_schema;")
+        for method, statements in recorded.items():
+            if method in FULL_TABLE_SCANS:
+                continue
+
+            for statement in statements:
+                if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                    continue
+                scans = full_scans(database, statement)
+                assert not scans, f"{method} scans a whole table ({', '.join(scans)}): {statement}"
+
+
+class TestMigrations:
+    def test_seven_to_eight(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE messages (message_id INT, channel INT, guild_id INT, limit_to_one INT);
+            CREATE TABLE reactionroles (message_id INT, reaction NVCARCHAR, role_id INT);
+            CREATE TABLE admins (role_id INT, guild_id INT);
+            CREATE TABLE cleanup_queue_guilds (guild_id INT, unix_timestamp INT);
+            CREATE TABLE guild_settings (guild_id INT, notify INT, systemchannel INT, language TEXT NULL);
+            CREATE TABLE dbinfo (version INT);
+            CREATE INDEX reactionroles_message_reaction_idx ON reactionroles (message_id, reaction);
+            CREATE INDEX admins_guild_role_idx ON admins (guild_id, role_id);
+            INSERT INTO dbinfo VALUES (7);
+            INSERT INTO messages VALUES (1, 10, 100, NULL), (2, 20, 200, 1);
+            INSERT INTO reactionroles VALUES (1, '🔥', 5), (1, '🔥', 5), (2, '💧', 6), (3, '🌱', 7);
+            INSERT INTO admins VALUES (8, 100), (8, 100);
+            INSERT INTO guild_settings VALUES (100, NULL, 0, 'it-it');
+            INSERT INTO cleanup_queue_guilds VALUES (200, 50), (200, 40);
+            """)
+        conn.commit()
+        conn.close()
+
+        handler = SchemaHandler(path, None)
+        assert handler.migrate_offline()
+        assert handler.version == SCHEMA_VERSION
+
+        db = Database(path)
+        with db.cursor() as cursor:
+            cursor.execute("SELECT * FROM messages ORDER BY message_id;")
+            assert cursor.fetchall() == [(1, 10, 100, 0), (2, 20, 200, 1)]
+            cursor.execute("SELECT * FROM reactionroles ORDER BY message_id;")
+            assert cursor.fetchall() == [(1, "🔥", 5), (2, "💧", 6)]
+            cursor.execute("SELECT * FROM admins;")
+            assert cursor.fetchall() == [(8, 100)]
+            cursor.execute("SELECT * FROM guild_settings;")
+            assert cursor.fetchall() == [(100, 0, 0, "it-it")]
+            cursor.execute("SELECT * FROM cleanup_queue_guilds;")
+            assert cursor.fetchall() == [(200, 40)]
+
+        db.remove_guild(100)
+        with db.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM reactionroles;")
+            assert cursor.fetchall() == [(2,)]
+        db.close()
+
+    def test_four_to_five(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE messages (message_id INT, channel INT, reactionrole_id INT, guild_id INT, limit_to_one INT);
+            CREATE TABLE reactionroles (reactionrole_id INT, reaction NVCARCHAR, role_id INT);
+            CREATE TABLE dbinfo (version INT);
+            INSERT INTO dbinfo VALUES (4);
+            INSERT INTO messages VALUES (1, 10, 50, 100, 0), (2, 20, 60, 200, 1);
+            INSERT INTO reactionroles VALUES (50, '🔥', 5), (50, '💧', 6), (60, '🌱', 7);
+            """)
+        conn.commit()
+        conn.close()
+
+        handler = SchemaHandler(path, None)
+        handler.apply(handler.four_to_five)
+        assert handler.version == 5
+
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT * FROM messages ORDER BY message_id;").fetchall() == [(1, 10, 100, 0), (2, 20, 200, 1)]
+        assert conn.execute("SELECT * FROM reactionroles ORDER BY role_id;").fetchall() == [
+            (1, "🔥", 5),
+            (1, "💧", 6),
+            (2, "🌱", 7),
+        ]
+        conn.close()
+
+    def test_failed_step_is_rolled_back(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "reactionlight.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE guild_settings (guild_id INT, notify INT, systemchannel INT);
+            CREATE TABLE dbinfo (version INT);
+            INSERT INTO dbinfo VALUES (5);
+            """)
+        conn.commit()
+        conn.close()
+
+        def failing_step(self, cursor):
+            cursor.execute("ALTER TABLE guild_settings ADD COLUMN 'language' TEXT NULL;")
+            raise sqlite3.OperationalError("interrupted")
+
+        monkeypatch.setattr(SchemaHandler, "five_to_six", failing_step)
+        handler = SchemaHandler(path, None)
+        with pytest.raises(sqlite3.OperationalError):
+            asyncio.run(handler.migrate())
+
+        assert handler.version == 5
+        assert SchemaHandler(path, None).version == 5
+        conn = sqlite3.connect(path)
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(guild_settings);")]
+        conn.close()
+        assert "language" not in columns
+
+    def test_fresh_database(self, database):
+        assert SchemaHandler(database.database, None).version == SCHEMA_VERSION
+        with database.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages' ORDER BY name;")
+            assert [row[0] for row in cursor.fetchall()] == ["messages_channel_idx", "messages_guild_id_idx"]
+
+    def test_migrate_offline(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE messages (message_id INT, channel INT, guild_id INT, limit_to_one INT);
+            CREATE TABLE dbinfo (version INT);
+            INSERT INTO dbinfo VALUES (1);
+            """)
+        conn.commit()
+        conn.close()
+
+        # Versions 0 and 1 need the Discord cache, so nothing runs before the bot connects
+        handler = SchemaHandler(path, None)
+        assert not handler.migrate_offline()
+        assert handler.version == 1
+
+
+class TestReactionRoleIndex:
+    def add_message(self, database):
+        database.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": None},
+                "limit_to_one": 0,
+                "reactions": {"🔥": ROLE_ID},
+            }
+        )
+
+    def test_writes_update_the_index(self, database):
+        self.add_message(database)
+        assert database.exists(MESSAGE_ID)
+        assert database.get_reactions(MESSAGE_ID) == {"🔥": ROLE_ID}
+
+        assert database.add_reaction(MESSAGE_ID, ROLE_ID + 1, "💧")
+        # Reactions already in use are refused and leave the index alone
+        assert not database.add_reaction(MESSAGE_ID, ROLE_ID + 2, "💧")
+        assert database.get_reactions(MESSAGE_ID) == {"🔥": ROLE_ID, "💧": ROLE_ID + 1}
+        assert database.resolve_reaction(MESSAGE_ID, "💧", GUILD_ID).role_id == ROLE_ID + 1
+
+        database.remove_reaction(MESSAGE_ID, "🔥")
+        assert database.get_reactions(MESSAGE_ID) == {"💧": ROLE_ID + 1}
+        assert database.resolve_reaction(MESSAGE_ID, "🔥", GUILD_ID).role_id is None
+
+        database.add_guild(CHANNEL_ID, GUILD_ID)
+        assert database.reactionroles_cache[MESSAGE_ID].guild_id == GUILD_ID
+
+        # The index matches what a reload reads from the tables
+        cached = dict(database.reactionroles_cache)
+        database.load_reactionroles()
+        assert database.reactionroles_cache == cached
+
+        database.delete(MESSAGE_ID)
+        assert not database.exists(MESSAGE_ID)
+        assert database.resolve_reaction(MESSAGE_ID, "💧", GUILD_ID) is None
+
+    def test_failed_writes_leave_the_index_unchanged(self, database):
+        self.add_message(database)
+        with database.cursor() as cursor:
+            for event, table in (("INSERT", "reactionroles"), ("DELETE", "reactionroles"), ("UPDATE", "messages")):
+                cursor.execute(
+                    f"CREATE TEMP TRIGGER fail_{event.lower()} BEFORE {event} ON {table} BEGIN SELECT RAISE(ABORT, 'failed'); END;"
+                )
+
+        with pytest.raises(sqlite3.Error):
+            database.add_reaction(MESSAGE_ID, ROLE_ID + 1, "💧")
+        with pytest.raises(sqlite3.Error):
+            database.remove_reaction(MESSAGE_ID, "🔥")
+        with pytest.raises(sqlite3.Error):
+            database.add_guild(CHANNEL_ID, GUILD_ID)
+
+        assert database.get_reactions(MESSAGE_ID) == {"🔥": ROLE_ID}
+        assert database.reactionroles_cache[MESSAGE_ID].guild_id is None
+
+
+class TestGuildPurge:
+    def test_remove_guilds(self, database):
+        for guild_id in (GUILD_ID, GUILD_ID + 1, GUILD_ID + 2):
+            database.add_reaction_role(
+                {
+                    "message": {"message_id": guild_id, "channel_id": CHANNEL_ID, "guild_id": guild_id},
+                    "limit_to_one": 0,
+                    "reactions": {"🔥": ROLE_ID},
+                }
+            )
+            database.add_admin(ROLE_ID, guild_id)
+            database.add_cleanup_guild(guild_id, 0)
+
+        database.remove_guilds([GUILD_ID, GUILD_ID + 1])
+
+        assert not database.exists(GUILD_ID) and not database.exists(GUILD_ID + 1)
+        assert database.exists(GUILD_ID + 2)
+        assert database.get_admins(GUILD_ID) == frozenset()
+        assert database.fetch_cleanup_guilds(guild_ids_only=True) == [GUILD_ID + 2]
+        with database.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT message_id FROM reactionroles;")
+            assert cursor.fetchall() == [(GUILD_ID + 2,)]
+            cursor.execute("SELECT guild_id FROM guild_settings;")
+            assert cursor.fetchall() == [(GUILD_ID + 2,)]
+
+
+class TestAsyncDatabase:
+    def test_get_language_never_queries_on_the_caller(self, database):
+        # The fixture's single cache slot holds GUILD_ID + 2, GUILD_ID + 1 was evicted
+        async_database = AsyncDatabase(database)
+        threads = []
+        database.conn.set_trace_callback(lambda _: threads.append(threading.current_thread().name))
+
+        # A miss answers with the global language and has the worker warm the cache
+        assert async_database.get_language(GUILD_ID + 1) is None
+        async_database.executor.submit(lambda: None).result()
+        assert async_database.get_language(GUILD_ID + 1) == "en-gb"
+
+        database.conn.set_trace_callback(None)
+        assert threads and all(name.startswith("database") for name in threads)
+        async_database.executor.shutdown(wait=True)
+
+    def test_cached_reaction_and_selection_from_memory(self, database):
+        async_database = AsyncDatabase(database)
+        database.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 1,
+                "reactions": {"🔥": ROLE_ID},
+            }
+        )
+        # The guild's settings are not cached yet
+        assert async_database.cached_resolve_reaction(MESSAGE_ID, "🔥", GUILD_ID) is None
+        resolved = asyncio.run(async_database.resolve_reaction(MESSAGE_ID, "🔥", GUILD_ID))
+        assert async_database.cached_resolve_reaction(MESSAGE_ID, "🔥", GUILD_ID) == resolved
+        assert async_database.cached_resolve_reaction(MESSAGE_ID + 1, "🔥", GUILD_ID) is None
+
+        # A miss is None, a user known to have no selection is NO_SELECTION
+        assert async_database.cached_selection(MESSAGE_ID, USER_ID) is None
+        assert asyncio.run(async_database.get_selection(MESSAGE_ID, USER_ID)) is None
+        assert async_database.cached_selection(MESSAGE_ID, USER_ID) == ""
+        asyncio.run(async_database.set_selection(MESSAGE_ID, USER_ID, "🔥"))
+        assert async_database.cached_selection(MESSAGE_ID, USER_ID) == "🔥"
+        async_database.executor.shutdown(wait=True)
+
+    def test_cached_admins_from_memory(self, database):
+        async_database = AsyncDatabase(database)
+        database.add_admin(ROLE_ID, GUILD_ID)
+        # Answered directly, without a round trip through the worker
+        assert async_database.cached_admins(GUILD_ID) is None
+        assert asyncio.run(async_database.get_admins(GUILD_ID)) == frozenset({ROLE_ID})
+        assert async_database.cached_admins(GUILD_ID) == frozenset({ROLE_ID})
+        async_database.executor.shutdown(wait=True)
+
+
+class TestStreaming:
+    def test_iter_all_guilds(self, database):
+        database.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 0,
+                "reactions": {"🔥": ROLE_ID},
+            }
+        )
+        database.add_admin(ROLE_ID, GUILD_ID)
+        database.add_admin(ROLE_ID, GUILD_ID + 3)
+
+        # Pages of one row still return every guild exactly once, in order
+        assert list(database.iter_all_guilds(chunk_size=1)) == [GUILD_ID, GUILD_ID + 1, GUILD_ID + 2, GUILD_ID + 3]
+        assert database.fetch_all_guilds() == [GUILD_ID, GUILD_ID + 1, GUILD_ID + 2, GUILD_ID + 3]
+
+    def test_rows_deleted_while_streaming(self, database):
+        for guild_id in range(1, 6):
+            database.add_cleanup_guild(guild_id, 0)
+
+        seen = []
+        for guild_id, _ in database.iter_cleanup_guilds(chunk_size=2):
+            seen.append(guild_id)
+            # Writing between pages is safe, and rows removed from later pages are skipped
+            database.remove_cleanup_guild(guild_id)
+            if guild_id == 1:
+                database.remove_cleanup_guild(4)
+        assert seen == [1, 2, 3, 5]
+        assert database.fetch_cleanup_guilds() == []
+
+
+class TestSelections:
+    def test_selections(self, database):
+        database.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 1,
+                "reactions": {"🔥": ROLE_ID, "💧": ROLE_ID + 1},
+            }
+        )
+        # A new message has no selections to backfill
+        assert database.selections_tracked(MESSAGE_ID)
+        database.set_selection(MESSAGE_ID, USER_ID, "🔥")
+        # Rows written before the backfill finished are newer than what it read
+        database.backfill_selections(MESSAGE_ID, {USER_ID: "💧", USER_ID + 1: "💧"})
+        assert database.selections_tracked(MESSAGE_ID)
+        assert database.get_selection(MESSAGE_ID, USER_ID) == "🔥"
+        assert database.get_selection(MESSAGE_ID, USER_ID + 1) == "💧"
+        assert database.get_selection(MESSAGE_ID, USER_ID + 2) is None
+
+        # Removing a reaction other than the selected one keeps the selection
+        database.clear_selection(MESSAGE_ID, USER_ID, "💧")
+        assert database.get_selection(MESSAGE_ID, USER_ID) == "🔥"
+        database.clear_selection(MESSAGE_ID, USER_ID, "🔥")
+        assert database.get_selection(MESSAGE_ID, USER_ID) is None
+
+        # The table is the source of truth, the cache only saves the lookups
+        database.selections_cache.clear()
+        assert database.get_selection(MESSAGE_ID, USER_ID) is None
+        assert database.get_selection(MESSAGE_ID, USER_ID + 1) == "💧"
+
+        # Selections are deleted with their message
+        database.delete(MESSAGE_ID)
+        assert not database.selections_tracked(MESSAGE_ID)
+        with database.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM selections;")
+            assert cursor.fetchone()[0] == 0
+            cursor.execute("SELECT COUNT(*) FROM selection_backfills;")
+            assert cursor.fetchone()[0] == 0
+
+    def test_new_messages_are_tracked(self, database):
+        for message_id, limit_to_one in ((MESSAGE_ID, 1), (MESSAGE_ID + 1, 0)):
+            database.add_reaction_role(
+                {
+                    "message": {"message_id": message_id, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                    "limit_to_one": limit_to_one,
+                    "reactions": {"🔥": ROLE_ID},
+                }
+            )
+        assert database.selections_tracked(MESSAGE_ID)
+        assert not database.selections_tracked(MESSAGE_ID + 1)
+        # The same as what a restart reads back
+        database.load_reactionroles()
+        assert database.tracked_selections == {MESSAGE_ID}
+
+    def test_tracked_messages_survive_restarts(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        db = Database(path)
+        db.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 1,
+                "reactions": {"🔥": ROLE_ID},
+            }
+        )
+        db.backfill_selections(MESSAGE_ID, {USER_ID: "🔥"})
+        db.close()
+
+        db = Database(path)
+        assert db.selections_tracked(MESSAGE_ID)
+        assert db.get_selection(MESSAGE_ID, USER_ID) == "🔥"
+        db.close()
+
+
+class TestCleanupQueue:
+    def test_due_guilds(self, database):
+        assert database.next_cleanup_timestamp() is None
+        for guild_id, unix_timestamp in ((1, 300), (2, 100), (3, 200)):
+            database.add_cleanup_guild(guild_id, unix_timestamp)
+
+        assert database.next_cleanup_timestamp() == 100
+        assert database.fetch_due_cleanup_guilds(200) == [(2, 100), (3, 200)]
+        assert database.fetch_due_cleanup_guilds(300, limit=1) == [(2, 100)]
+        assert database.fetch_due_cleanup_guilds(50) == []
+
+    def test_queued_guilds_in_memory(self, database):
+        database.add_cleanup_guild(1, 100)
+        database.add_cleanup_guild(2, 100)
+        database.add_cleanup_guild(3, 100)
+        database.remove_cleanup_guild(1)
+        database.remove_guilds([2])
+        assert [database.cleanup_queued(guild_id) for guild_id in (1, 2, 3)] == [False, False, True]
+
+        database.cleanup_guilds.clear()
+        database.load_caches()
+        assert database.cleanup_guilds == {3}
+
+
+class TestMaintenance:
+    def test_sweep_orphans(self, database):
+        database.add_reaction_role(
+            {
+                "message": {"message_id": MESSAGE_ID, "channel_id": CHANNEL_ID, "guild_id": GUILD_ID},
+                "limit_to_one": 0,
+                "reactions": {"🔥": ROLE_ID},
+            }
+        )
+        database.add_admin(ROLE_ID, GUILD_ID)
+        database.add_admin(ROLE_ID, GUILD_ID + 1)
+        database.add_cleanup_guild(GUILD_ID + 2, 0)
+        with database.cursor() as cursor:
+            cursor.execute("PRAGMA foreign_keys = OFF;")
+            cursor.execute("INSERT INTO reactionroles VALUES (?, '💧', ?);", (MESSAGE_ID + 1, ROLE_ID))
+            cursor.execute("PRAGMA foreign_keys = ON;")
+
+        # GUILD_ID + 1 is gone, GUILD_ID + 2 is left to the cleanup queue
+        assert database.sweep_orphans([GUILD_ID]) == {"reactionroles": 1, "admins": 1, "guild_settings": 1}
+        assert database.get_admins(GUILD_ID) == frozenset({ROLE_ID})
+        assert database.get_admins(GUILD_ID + 1) == frozenset()
+        with database.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM reactionroles;")
+            assert cursor.fetchall() == [(MESSAGE_ID,)]
+            cursor.execute("SELECT guild_id FROM guild_settings ORDER BY guild_id;")
+            assert cursor.fetchall() == [(GUILD_ID + 2,)]
+
+        # Nothing is known about the bot's guilds, so only reaction-roles are swept
+        assert database.sweep_orphans([]) == {"reactionroles": 0, "admins": 0, "guild_settings": 0}
+
+    def test_incremental_vacuum(self, database):
+        for guild_id in range(2000):
+            database.add_cleanup_guild(guild_id, guild_id)
+        database.flush()
+        database.remove_guilds(range(2000))
+
+        free, page_size = database.free_pages()
+        assert free > 0 and page_size > 0
+        assert database.incremental_vacuum(1) == 1
+        while database.incremental_vacuum(64):
+            pass
+        assert database.free_pages()[0] == 0
+
+    def test_nine_to_ten(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        Database(path).close()
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = DELETE;")
+        conn.execute("PRAGMA auto_vacuum = NONE;")
+        conn.execute("VACUUM;")
+        conn.execute("UPDATE dbinfo SET version = 9;")
+        conn.commit()
+        assert conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 0
+        conn.close()
+
+        handler = SchemaHandler(path, None)
+        assert handler.migrate_offline()
+        assert handler.version == SCHEMA_VERSION
+        conn = sqlite3.connect(path)
+        assert conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2
+        conn.close()
+
+
+class TestWriteBatching:
+    def test_group_commit(self, tmp_path):
+        path = str(tmp_path / "reactionlight.db")
+        db = Database(path, batch_window=60, batch_size=3)
+        reader = sqlite3.connect(path)
+
+        def committed_cleanup_guilds():
+            return [row[0] for row in reader.execute("SELECT guild_id FROM cleanup_queue_guilds ORDER BY guild_id;")]
+
+        db.add_cleanup_guild(1, 0)
+        db.add_cleanup_guild(2, 0)
+        # Pending writes are visible to the bot but not committed yet
+        assert db.fetch_cleanup_guilds(guild_ids_only=True) == [1, 2]
+        assert committed_cleanup_guilds() == []
+
+        # A failing write only rolls back itself
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_cleanup_guild(1, 0)
+        assert db.pending_writes == 2
+
+        # Reaching batch_size commits the whole batch
+        db.add_cleanup_guild(3, 0)
+        assert committed_cleanup_guilds() == [1, 2, 3]
+
+        db.remove_cleanup_guild(1)
+        assert committed_cleanup_guilds() == [1, 2, 3]
+        db.flush()
+        assert committed_cleanup_guilds() == [2, 3]
+
+        reader.close()
+        db.close()
+
+
+class TestInstrumentation:
+    def test_method_stats(self, database):
+        database.add_admin(ROLE_ID, GUILD_ID)
+        database.add_admin(ROLE_ID + 1, GUILD_ID)
+        database.get_admins(GUILD_ID)
+        list(database.iter_all_guilds())
+
+        methods = database.instrumentation.snapshot()["methods"]
+        assert methods["add_admin"]["calls"] == 2
+        assert methods["get_admins"]["rows"] == 2
+        assert methods["iter_all_guilds"]["calls"] == 1
+        assert sum(methods["get_admins"]["histogram"].values()) == 1
+
+    def test_memory_only_lookups_are_not_measured(self, database):
+        database.exists(MESSAGE_ID)
+        database.cached_admins(GUILD_ID)
+        methods = database.instrumentation.snapshot()["methods"]
+        assert "exists" not in methods and "cached_admins" not in methods
+
+    def test_slow_query_log(self, database):
+        database.instrumentation.slow_query_ms = 0
+        database.get_admins(GUILD_ID)
+
+        query = database.instrumentation.slow_queries[-1]
+        assert query.method == "get_admins"
+        assert query.parameters == repr((GUILD_ID,))
+        assert query.plan == ["SEARCH admins USING PRIMARY KEY (guild_id=?)"]
+        assert "get_admins" in database.instrumentation.report()
@@ -0,0 +1,37 @@
+import asyncio
+import gc
+
+from cogs.utils.locks import Locks
+
+
+class TestLocks:
+    def test_unused_locks_are_reclaimed(self):
+        async def scenario():
+            locks = Locks()
+            for user_id in range(1000):
+                async with locks.get_lock(1, 2, user_id):
+                    pass
+            gc.collect()
+            return locks.stats()
+
+        stats = asyncio.run(scenario())
+        assert stats["size"] == 0
+        assert stats["created"] == stats["acquisitions"] == 1000
+
+    def test_same_key_same_lock(self):
+        async def scenario():
+            locks = Locks()
+            order = []
+
+            async def handler(name):
+                async with locks.get_lock(1, 2, 3):
+                    order.append(f"{name} start")
+                    await asyncio.sleep(0.01)
+                    order.append(f"{name} end")
+
+            await asyncio.gather(handler("first"), handler("second"), handler("third"))
+            return order, locks.stats()
+
+        order, stats = asyncio.run(scenario())
+        assert order == ["first start", "first end", "second start", "second end", "third start", "third end"]
+        assert stats["created"] == 1 and stats["contended"] == 2 and stats["peak_size"] == 1
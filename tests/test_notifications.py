@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+import disnake
+
+from cogs.utils.notifications import NotificationDispatcher
+
+GUILD_ID = 3000
+USER_ID = 5000
+ROLES = [SimpleNamespace(id=role_id, name=f"role-{role_id}") for role_id in (4000, 4001, 4002)]
+
+
+def http_error(status):
+    return (disnake.Forbidden if status == 403 else disnake.HTTPException)(SimpleNamespace(status=status, reason=""), "")
+
+
+def dispatch(requests, failures=(), **settings):
+    # Runs the requests through a dispatcher and returns the summaries it delivered and its counters
+    async def scenario():
+        sent = []
+        errors = list(failures)
+
+        async def send(notification):
+            if errors:
+                raise errors.pop(0)
+            sent.append((notification.user_id, notification.added, notification.removed))
+
+        dispatcher = NotificationDispatcher(send, window=0.01, rate=0, **settings)
+        for user_id, role, added in requests:
+            dispatcher.notify(user_id, GUILD_ID, role, added)
+        await asyncio.sleep(0.05)
+        await dispatcher.queue.join()
+        dispatcher.stop()
+        return sent, dispatcher.stats()
+
+    return asyncio.run(scenario())
+
+
+class TestNotificationDispatcher:
+    def test_net_change_in_one_summary(self):
+        sent, stats = dispatch(
+            [
+                (USER_ID, ROLES[0], True),
+                (USER_ID, ROLES[1], True),
+                (USER_ID, ROLES[2], False),
+                (USER_ID, ROLES[1], False),
+                (USER_ID + 1, ROLES[0], True),
+            ]
+        )
+        assert sorted(sent) == [(USER_ID, ["role-4000"], ["role-4002"]), (USER_ID + 1, ["role-4000"], [])]
+        assert stats["requested"] == 5 and stats["sent"] == 2
+
+    def test_flicker_sends_nothing(self):
+        sent, stats = dispatch([(USER_ID, ROLES[0], True), (USER_ID, ROLES[0], False), (USER_ID, ROLES[0], True)])
+        assert sent == [(USER_ID, ["role-4000"], [])]
+        sent, stats = dispatch([(USER_ID, ROLES[0], True), (USER_ID, ROLES[0], False)])
+        assert sent == []
+        assert stats["collapsed"] == 1 and stats["queued"] == 0
+
+    def test_full_queue_drops(self):
+        sent, stats = dispatch([(user_id, ROLES[0], True) for user_id in range(10)], queue_size=3, workers=1)
+        assert stats["dropped"] > 0
+        assert stats["sent"] + stats["dropped"] == 10
+
+    def test_retries(self):
+        sent, stats = dispatch([(USER_ID, ROLES[0], True)], failures=[http_error(500)], retries=1)
+        assert sent == [(USER_ID, ["role-4000"], [])]
+        assert stats["retried"] == 1 and stats["sent"] == 1
+
+        # Users that do not accept DMs are not retried
+        sent, stats = dispatch([(USER_ID, ROLES[0], True)], failures=[http_error(403)], retries=1)
+        assert sent == [] and stats["failed"] == 1 and stats["retried"] == 0
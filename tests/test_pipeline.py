@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+
+from cogs.utils.pipeline import EventPipeline
+
+
+def run_events(events, **settings):
+    # Submits (guild id, event) pairs at once and returns the order they were handled in and the pipeline statistics
+    async def scenario():
+        pipeline = EventPipeline(**settings)
+        handled = []
+
+        async def handler(event):
+            await asyncio.sleep(0.001)
+            if event == "fail":
+                raise RuntimeError("handler failed")
+            handled.append(event)
+
+        for guild_id, event in events:
+            pipeline.submit(guild_id, handler, event)
+        while pipeline.queues or pipeline.running:
+            await asyncio.sleep(0.01)
+        pipeline.stop()
+        return handled, pipeline.stats()
+
+    return asyncio.run(scenario())
+
+
+class TestEventPipeline:
+    def test_guilds_take_turns(self):
+        # A burst in guild 1 does not make guild 2 wait for all of it
+        events = [(1, f"burst-{i}") for i in range(50)] + [(2, "other")]
+        handled, stats = run_events(events, workers=1, guild_concurrency=1)
+        assert handled.index("other") == 1
+        assert stats["handled"] == 51 and stats["depth"] == 0
+
+    def test_drop_policies(self):
+        events = [(1, i) for i in range(10)]
+        handled, stats = run_events(events, workers=1, guild_queue_size=3, drop_policy="oldest")
+        assert handled == [7, 8, 9]
+        assert stats["dropped"] == 7
+
+        handled, stats = run_events(events, workers=1, guild_queue_size=3, drop_policy="newest")
+        assert handled == [0, 1, 2]
+        assert stats["dropped"] == 7
+
+        with pytest.raises(ValueError):
+            EventPipeline(drop_policy="random")
+
+    def test_failures_do_not_stop_workers(self):
+        handled, stats = run_events([(1, "fail"), (1, "ok")], workers=1)
+        assert handled == ["ok"]
+        assert stats["failed"] == 1 and stats["handled"] == 1
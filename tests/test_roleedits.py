@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+import disnake
+
+from cogs.utils.roleedits import RoleEditCoalescer
+
+GUILD_ID = 3000
+ROLES = [SimpleNamespace(id=role_id) for role_id in (4000, 4001, 4002)]
+
+
+class FakeMember:
+    # Records the API calls instead of making them
+    def __init__(self, member_id, roles=()):
+        self.id = member_id
+        self.guild = SimpleNamespace(id=GUILD_ID)
+        self.roles = list(roles)
+        self.calls = []
+        self.error = None
+        self.delay = 0
+
+    async def call(self, name, roles):
+        self.calls.append((name, [role.id for role in roles]))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+            self.calls.append(("done", [role.id for role in roles]))
+        if self.error is not None:
+            raise self.error
+
+    async def add_roles(self, *roles):
+        await self.call("add_roles", roles)
+
+    async def remove_roles(self, *roles):
+        await self.call("remove_roles", roles)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestRoleEditCoalescer:
+    def test_single_change(self):
+        async def scenario():
+            coalescer = RoleEditCoalescer(0.01)
+            member = FakeMember(1)
+            assert await coalescer.add(member, ROLES[0])
+            return member.calls
+
+        assert run(scenario()) == [("add_roles", [4000])]
+
+    def test_add_then_remove_cancels_out(self):
+        async def scenario():
+            coalescer = RoleEditCoalescer(0.01)
+            member = FakeMember(1)
+            results = await asyncio.gather(coalescer.add(member, ROLES[0]), coalescer.remove(member, ROLES[0]))
+            # The window still closes, with nothing left to apply
+            await asyncio.sleep(0.05)
+            return results, member.calls, coalescer.stats()
+
+        results, calls, stats = run(scenario())
+        assert results == [False, False]
+        assert calls == []
+        assert stats == {"pending": 0, "requested": 2, "api_calls": 0}
+
+    def test_swap_leaves_other_roles_alone(self):
+        async def scenario():
+            coalescer = RoleEditCoalescer(0.01)
+            member = FakeMember(1, roles=[ROLES[0], ROLES[2]])
+            # Two members are edited separately
+            other = FakeMember(2)
+            results = await asyncio.gather(
+                coalescer.remove(member, ROLES[0]), coalescer.add(member, ROLES[1]), coalescer.add(other, ROLES[1])
+            )
+            return results, member.calls, other.calls
+
+        results, calls, other_calls = run(scenario())
+        assert results == [True, True, True]
+        # Only the changed roles are sent, never a full role list built from a possibly stale member
+        assert calls == [("add_roles", [4001]), ("remove_roles", [4000])]
+        assert other_calls == [("add_roles", [4001])]
+
+    def test_windows_of_a_member_run_in_turn(self):
+        async def scenario():
+            coalescer = RoleEditCoalescer(0.01)
+            member = FakeMember(1, roles=[ROLES[2]])
+            member.delay = 0.05
+            first = coalescer.add(member, ROLES[0])
+            # Queued while the first window's call is still in flight
+            await asyncio.sleep(0.02)
+            second = [coalescer.add(member, ROLES[1]), coalescer.remove(member, ROLES[2])]
+            results = await asyncio.gather(first, *second)
+            await asyncio.sleep(0.02)
+            return results, member.calls, coalescer.tasks
+
+        results, calls, tasks = run(scenario())
+        assert results == [True, True, True]
+        assert calls == [
+            ("add_roles", [4000]),
+            ("done", [4000]),
+            ("add_roles", [4001]),
+            ("done", [4001]),
+            ("remove_roles", [4002]),
+            ("done", [4002]),
+        ]
+        assert tasks == {}
+
+    def test_errors_reach_every_request(self):
+        async def scenario():
+            coalescer = RoleEditCoalescer(0.01)
+            member = FakeMember(1)
+            member.error = disnake.HTTPException(SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions")
+            futures = [coalescer.add(member, ROLES[0]), coalescer.add(member, ROLES[0])]
+            return await asyncio.gather(*futures, return_exceptions=True)
+
+        results = run(scenario())
+        assert len(results) == 2 and all(isinstance(result, disnake.HTTPException) for result in results)
+        assert results[0] is results[1]
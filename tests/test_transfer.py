@@ -0,0 +1,59 @@
+import sqlite3
+import pytest
+
+from cogs.utils.database import Database
+from cogs.utils.transfer import TABLES, TransferError, export_data, import_data
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "source.db")
+    db = Database(path)
+    for message_id in (1, 2):
+        db.add_reaction_role(
+            {
+                "message": {"message_id": message_id, "channel_id": 10, "guild_id": 100},
+                "limit_to_one": message_id - 1,
+                "reactions": {"🔥": 5, "<:custom:123>": 6},
+            }
+        )
+    db.add_admin(7, 100)
+    db.set_language(100, "it-it")
+    db.close()
+    return path
+
+
+def dump(path):
+    conn = sqlite3.connect(path)
+    tables = {table: conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2;").fetchall() for table in TABLES}
+    conn.close()
+    return tables
+
+
+class TestTransfer:
+    @pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+    def test_round_trip(self, database, tmp_path, fmt):
+        destination = str(tmp_path / f"export.{fmt}")
+        counts = export_data(database, destination, fmt)
+        assert counts == {"messages": 2, "reactionroles": 4, "admins": 1, "guild_settings": 1}
+
+        target = str(tmp_path / "target.db")
+        progress = []
+        assert import_data(target, destination, fmt, batch_size=3, progress=lambda *args: progress.append(args)) == counts
+        assert dump(target) == dump(database)
+        assert ("reactionroles", 3) in progress
+
+        # Importing again updates the existing rows instead of failing
+        import_data(target, destination, fmt)
+        assert dump(target) == dump(database)
+
+    def test_invalid_rows_roll_back(self, tmp_path):
+        source = tmp_path / "broken.ndjson"
+        source.write_text(
+            '{"table": "admins", "role_id": 1, "guild_id": 2}\n'
+            '{"table": "reactionroles", "message_id": 99, "reaction": "🔥", "role_id": 5}\n'
+        )
+        target = str(tmp_path / "target.db")
+        with pytest.raises(TransferError):
+            import_data(target, str(source))
+        assert dump(target)["admins"] == []